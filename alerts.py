@@ -0,0 +1,269 @@
+﻿import html
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+
+from config import ORDER_DETAILS_PREFIX
+from payloads import AlertEvent
+from utils import format_pay_type
+
+logger = logging.getLogger(__name__)
+
+DT_FORMAT = "%d.%m.%Y %H:%M:%S"
+# Footer appended to the original alert for each lifecycle update, and
+# whether the alert body is struck through
+UPDATE_LABELS = {
+    "paid": ("✅ Ордер оплачен", False),
+    "completed": ("✅ Ордер завершён", False),
+    "cancelled": ("❌ Ордер отменён", True),
+    "expired": ("⌛ Ордер истёк", True),
+}
+DIGEST_MAX_ORDERS = 30  # order lines listed in one digest, keeps it under 4096 chars
+
+
+def parse_platform_datetime(raw: str) -> datetime:
+    """Parse the platform's ``dd.mm.YYYY HH:MM:SS`` timestamps.
+
+    Slices the fixed-width string instead of going through ``strptime``;
+    anything that does not have the exact layout is handed to ``strptime``
+    so the accepted inputs and the ValueError on bad ones stay the same.
+    """
+    if (
+        len(raw) == 19
+        and raw[2] == "." and raw[5] == "." and raw[10] == " "
+        and raw[13] == ":" and raw[16] == ":"
+    ):
+        parts = (raw[6:10], raw[3:5], raw[0:2], raw[11:13], raw[14:16], raw[17:19])
+        if "".join(parts).isdigit():
+            try:
+                return datetime(*map(int, parts))
+            except ValueError:
+                pass
+    return datetime.strptime(raw, DT_FORMAT)
+
+
+@lru_cache(maxsize=64)
+def utc_offset(value) -> tuple[int, timedelta, str]:
+    """Return ``(hours, shift, display)`` for the payload's ``UTC`` field."""
+    hours = int(value)
+    display = f"+{hours}" if hours >= 0 else str(hours)
+    return hours, timedelta(hours=hours), display
+
+
+@dataclass(frozen=True, slots=True)
+class RenderedAlert:
+    """Alert message rendered once per event and shared by all recipients."""
+    status: str
+    order_id: str
+    text: str
+    parse_mode: str = ParseMode.HTML
+    reply_markup: InlineKeyboardMarkup | None = field(default=None, compare=False)
+
+    def send_kwargs(self) -> dict:
+        """Keyword arguments for ``bot.send_message`` (without ``chat_id``)."""
+        kwargs = {"text": self.text, "parse_mode": self.parse_mode}
+        if self.reply_markup is not None:
+            kwargs["reply_markup"] = self.reply_markup
+        return kwargs
+
+
+def details_markup(order_id: str) -> InlineKeyboardMarkup | None:
+    """"Details" button of an alert; None if the id does not fit callback data."""
+    data = f"{ORDER_DETAILS_PREFIX}{order_id}"
+    if len(data.encode()) > 64:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton("📋 Детали", callback_data=data)]])
+
+
+def _fmt(dt: datetime | None, part: str) -> str:
+    if not dt:
+        return "ошибка"
+    if part == "time":
+        return f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year:04d}"
+
+
+def _requisites(event: AlertEvent) -> str:
+    card_last = event.card_number[-4:]
+    iban_last = event.iban_account[-4:]
+    name = event.requisites_name
+    holder_name = event.cardholder_name
+    holder_initial = event.cardholder_surname[:1]
+
+    if event.pay_type.lower() == "iban":
+        return (
+            f"{name} "
+            f"UA***{iban_last}, {holder_name} {holder_initial}."
+        )
+    return (
+        f"{name} *{card_last}, "
+        f"{holder_name} {holder_initial}."
+    )
+
+
+def render_alert(event: AlertEvent) -> RenderedAlert:
+    """Build the order or appeal alert for a validated platform event."""
+    if event.status == "order":
+        created_raw = event.order_date_created
+        timer_raw = event.order_timer
+        title = "💸 Новый ордер"
+    else:  # appeal
+        created_raw = event.appeal_date_created
+        timer_raw = event.appeal_timer
+        title = "⚠️ Новая апелляция"
+
+    _, utc_shift, utc_display = utc_offset(event.utc)
+    created_dt = None
+    closing_dt = None
+
+    try:
+        created_dt = parse_platform_datetime(created_raw) + utc_shift
+        closing_dt = created_dt + timedelta(minutes=int(timer_raw or 0))
+    except Exception as e:
+        logger.error(f"Date parse error: {e}")
+
+    created_time_str = _fmt(created_dt, "time")
+    created_date_str = _fmt(created_dt, "date")
+    closing_time_str = _fmt(closing_dt, "time")
+    closing_date_str = _fmt(closing_dt, "date")
+
+    pay_type = event.pay_type.lower()
+    pay_display = format_pay_type(pay_type)
+
+    req_str = _requisites(event)
+
+    if event.status == "order":
+        msg = (
+            f"{title}\n\n"
+            f"🔹 Сумма, фиат: {event.fiat_amount} {event.currency}\n"
+            f"🔹 Реквизиты: {req_str}\n"
+            f"🔹 Способ оплаты: {pay_display}\n\n"
+            f"▫️ ID ордера: {event.order_id}\n"
+            f"▫️ Ордер создан {created_time_str} (UTC{utc_display}), {created_date_str}\n"
+            f"▫️ Ордер будет закрыт {closing_time_str} (UTC{utc_display}), {closing_date_str}\n\n"
+            f"🔹 Мой курс: {event.trader_rate} ({event.trader_fee}%)\n"
+            f"🔹 Курс биржи: {event.exchange_rate}"
+        )
+    else:  # appeal
+        order_created_dt = None
+        try:
+            order_created_dt = parse_platform_datetime(event.order_date_created) + utc_shift
+        except Exception:
+            pass
+
+        order_created_time = _fmt(order_created_dt, "time")
+        order_created_date = _fmt(order_created_dt, "date")
+
+        msg = (
+            f"{title}\n\n"
+            f"🔸 Сумма, фиат: {event.fiat_amount} {event.currency}\n"
+            f"🔸 Реквизиты: {req_str}\n"
+            f"🔸 Способ оплаты: {pay_display}\n\n"
+            f"▫️ ID ордера: {event.order_id}\n"
+            f"▫️ Ордер создан {order_created_time} (UTC{utc_display}), {order_created_date}\n"
+            f"▫️ Апелляция создана {created_time_str} (UTC{utc_display}), {created_date_str}\n"
+            f"▫️ Апелляция будет закрыта {closing_time_str} (UTC{utc_display}), {closing_date_str}"
+        )
+
+    return RenderedAlert(
+        status=event.status,
+        order_id=event.order_id,
+        text=msg,
+        reply_markup=details_markup(event.order_id),
+    )
+
+
+def render_digest(events) -> RenderedAlert:
+    """Merge several alerts for one chat into a single summary message."""
+    orders = sum(1 for event in events if event.status == "order")
+    appeals = len(events) - orders
+
+    totals = {}
+    for event in events:
+        try:
+            amount = Decimal(event.fiat_amount)
+        except InvalidOperation:
+            continue
+        totals[event.currency] = totals.get(event.currency, Decimal(0)) + amount
+    totals_str = ", ".join(
+        f"{format(total.normalize(), 'f')} {html.escape(currency)}"
+        for currency, total in totals.items()
+    ) or "—"
+
+    lines = [
+        f"▫️ ID ордера: {html.escape(event.order_id)} — {html.escape(event.fiat_amount)} {html.escape(event.currency)}"
+        + (" (апелляция)" if event.status == "appeal" else "")
+        for event in events[:DIGEST_MAX_ORDERS]
+    ]
+    if len(events) > DIGEST_MAX_ORDERS:
+        lines.append(f"… и ещё {len(events) - DIGEST_MAX_ORDERS}")
+
+    msg = (
+        f"📦 Новых событий: {len(events)}\n\n"
+        f"🔹 Ордеров: {orders}, апелляций: {appeals}\n"
+        f"🔹 Сумма, фиат: {totals_str}\n\n"
+        + "\n".join(lines)
+    )
+    status = "appeal" if appeals else "order"
+    return RenderedAlert(status=status, order_id=events[0].order_id, text=msg)
+
+
+def render_update(order_id: str, original_text: str, status: str) -> RenderedAlert:
+    """Rewrite a sent alert (its original text) for an order lifecycle update."""
+    footer, strike = UPDATE_LABELS[status]
+    body = f"<s>{original_text}</s>" if strike else original_text
+    return RenderedAlert(
+        status=status,
+        order_id=order_id,
+        text=f"{body}\n\n{footer}",
+        reply_markup=details_markup(order_id),
+    )
+
+
+# Order state shown in the details view
+STATUS_LABELS = {
+    "order": "🟢 Открыт",
+    "appeal": "⚠️ Апелляция",
+    **{status: footer for status, (footer, _) in UPDATE_LABELS.items()},
+}
+
+
+def render_details(event: AlertEvent, status: str) -> str:
+    """Details view of a cached order shown by the "Details" button."""
+    _, utc_shift, utc_display = utc_offset(event.utc)
+    created_dt = None
+    closing_dt = None
+    try:
+        created_dt = parse_platform_datetime(event.order_date_created) + utc_shift
+        closing_dt = created_dt + timedelta(minutes=int(event.order_timer or 0))
+    except Exception:
+        pass
+
+    appeal_line = ""
+    if event.appeal_date_created:
+        try:
+            appeal_dt = parse_platform_datetime(event.appeal_date_created) + utc_shift
+            appeal_line = (
+                f"▫️ Апелляция создана {_fmt(appeal_dt, 'time')} (UTC{utc_display}), "
+                f"{_fmt(appeal_dt, 'date')}\n"
+            )
+        except Exception:
+            pass
+
+    return (
+        f"📋 Детали ордера {event.order_id}\n\n"
+        f"Статус: {STATUS_LABELS.get(status, status)}\n\n"
+        f"🔹 Сумма, фиат: {event.fiat_amount} {event.currency}\n"
+        f"🔹 Реквизиты: {_requisites(event)}\n"
+        f"🔹 Способ оплаты: {format_pay_type(event.pay_type.lower())}\n\n"
+        f"▫️ Ордер создан {_fmt(created_dt, 'time')} (UTC{utc_display}), {_fmt(created_dt, 'date')}\n"
+        f"▫️ Ордер будет закрыт {_fmt(closing_dt, 'time')} (UTC{utc_display}), {_fmt(closing_dt, 'date')}\n"
+        f"{appeal_line}\n"
+        f"🔹 Мой курс: {event.trader_rate} ({event.trader_fee}%)\n"
+        f"🔹 Курс биржи: {event.exchange_rate}"
+    )
@@ -0,0 +1,53 @@
+﻿"""Micro-benchmark of alert timestamp handling.
+
+Compares the previous ``strptime``/``strftime`` code path with
+``alerts.parse_platform_datetime`` and the cached UTC offsets.
+Run from the repository root: ``python -m bench.bench_dates``
+"""
+import timeit
+from datetime import datetime, timedelta
+
+from alerts import DT_FORMAT, parse_platform_datetime, utc_offset, _fmt
+
+RAW = "14.03.2025 18:42:07"
+UTC = "3"
+TIMER = "15"
+NUMBER = 100_000
+
+
+def old_path():
+    offset = int(UTC)
+    created = datetime.strptime(RAW, DT_FORMAT) + timedelta(hours=offset)
+    closing = created + timedelta(minutes=int(TIMER))
+    display = f"+{offset}" if offset >= 0 else str(offset)
+    return (
+        created.strftime("%H:%M:%S"), created.strftime("%d.%m.%Y"),
+        closing.strftime("%H:%M:%S"), closing.strftime("%d.%m.%Y"), display,
+    )
+
+
+def new_path():
+    _, shift, display = utc_offset(UTC)
+    created = parse_platform_datetime(RAW) + shift
+    closing = created + timedelta(minutes=int(TIMER))
+    return (
+        _fmt(created, "time"), _fmt(created, "date"),
+        _fmt(closing, "time"), _fmt(closing, "date"), display,
+    )
+
+
+def main():
+    assert old_path() == new_path()
+    cases = (
+        ("strptime parse", lambda: datetime.strptime(RAW, DT_FORMAT)),
+        ("fast parse", lambda: parse_platform_datetime(RAW)),
+        ("old alert dates", old_path),
+        ("new alert dates", new_path),
+    )
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+        print(f"{name:>16}: {seconds / NUMBER * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+﻿"""Micro-benchmark of the SQLite connection layer.
+
+Compares the previous connect-per-call pattern (default rollback journal,
+original schema without a username index) with the reused, WAL-tuned
+connection of ``database.connect()`` and with the in-memory user cache on
+two hot lookups and one write. Run from the repository root:
+``python -m bench.db_bench [--users N]``
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import timeit
+
+NUMBER = 2_000
+
+SCHEMA = """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE,
+        tg_username TEXT,
+        platform_username TEXT,
+        notifications_enabled INTEGER DEFAULT 0,
+        appeal_notifications_enabled INTEGER DEFAULT 0,
+        role TEXT DEFAULT 'user',
+        banned INTEGER DEFAULT 0
+    )
+"""
+
+
+def seed_rows(users: int):
+    return [(1_000_000 + i, f"tg_{i}", f"trader_{i % (users // 4 or 1)}") for i in range(users)]
+
+
+def old_is_user_authorized(path, telegram_id):
+    with sqlite3.connect(path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT banned FROM users WHERE telegram_id = ?", (telegram_id,))
+        row = cursor.fetchone()
+        return row is not None and row[0] == 0
+
+
+def old_get_user_ids(path, platform_username):
+    with sqlite3.connect(path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT telegram_id FROM users WHERE platform_username = ? AND banned = 0",
+            (platform_username,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def old_set_order_status(path, telegram_id, status):
+    with sqlite3.connect(path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET notifications_enabled = ? WHERE telegram_id = ?",
+            (1 if status else 0, telegram_id),
+        )
+        conn.commit()
+
+
+def report(name, func, number=NUMBER):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print(f"{name:>36}: {seconds / number * 1e6:8.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="db_bench_")
+    old_path = os.path.join(workdir, "old.db")
+    new_path = os.path.join(workdir, "new.db")
+    rows = seed_rows(args.users)
+
+    with sqlite3.connect(old_path) as conn:
+        conn.execute(SCHEMA)
+        conn.executemany(
+            "INSERT INTO users (telegram_id, tg_username, platform_username) VALUES (?, ?, ?)", rows
+        )
+
+    os.environ["DB_NAME"] = new_path
+    import database  # reads DB_NAME on import
+
+    database.init_db()
+    with database.connect() as conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_id, tg_username, platform_username) VALUES (?, ?, ?)", rows
+        )
+
+    telegram_id = rows[len(rows) // 2][0]
+    username = rows[len(rows) // 2][2]
+    assert old_is_user_authorized(old_path, telegram_id) == database.is_user_authorized(telegram_id)
+    assert old_get_user_ids(old_path, username) == database.get_user_ids_by_platform_username(username)
+
+    print(f"{args.users} users, {len(old_get_user_ids(old_path, username))} per platform username")
+    report("is_user_authorized, connect per call", lambda: old_is_user_authorized(old_path, telegram_id))
+    report("is_user_authorized, pooled", lambda: database.is_user_authorized(telegram_id))
+    report("get_user_ids, connect per call", lambda: old_get_user_ids(old_path, username))
+    report("get_user_ids, pooled", lambda: database.get_user_ids_by_platform_username(username))
+    report("set_order_status, connect per call", lambda: old_set_order_status(old_path, telegram_id, True), 200)
+    report("set_order_status, pooled", lambda: database.set_order_notification_status(telegram_id, True), 200)
+
+    database.load_user_cache()
+    assert old_get_user_ids(old_path, username) == database.get_user_ids_by_platform_username(username)
+    report("is_user_authorized, user cache", lambda: database.is_user_authorized(telegram_id))
+    report("get_user_ids, user cache", lambda: database.get_user_ids_by_platform_username(username))
+    report("set_order_status, user cache", lambda: database.set_order_notification_status(telegram_id, True), 200)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+﻿"""Local stand-in for the Telegram Bot API used by the benchmarks.
+
+Answers the calls the bot makes (getMe, sendMessage, editMessageText,
+getUpdates, set/deleteWebhook) with configurable latency, 429 injection and
+error rate, and records when every alert reached it so the load generator
+can compute webhook-to-delivery latency. Also stands in for the platform's
+AUTH_ENDPOINT at /auth and accepts every login.
+
+    python -m bench.fake_bot_api --port 8081 --latency-ms 40 --rate-429 0.01
+
+Point the bot at it with TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot
+and AUTH_ENDPOINT=http://127.0.0.1:8081/auth
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from collections import Counter
+from itertools import count
+from urllib.parse import parse_qsl
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+ORDER_ID_RE = re.compile(r"ID ордера: (\S+)")
+
+app = FastAPI()
+settings = argparse.Namespace(
+    latency_ms=40.0, jitter_ms=10.0, rate_429=0.0, retry_after=1, error_rate=0.0
+)
+message_ids = count(1)
+calls = Counter()
+deliveries = {}  # order_id -> [delivery timestamps]
+
+
+async def read_params(request: Request) -> dict:
+    """PTB posts form-encoded parameters, other clients may send JSON."""
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return json.loads(body or b"{}")
+    return dict(parse_qsl(body.decode()))
+
+
+def ok(result):
+    return {"ok": True, "result": result}
+
+
+def message(params: dict) -> dict:
+    chat_id = int(params.get("chat_id", 0))
+    return {
+        "message_id": int(params.get("message_id") or next(message_ids)),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "text": params.get("text", ""),
+    }
+
+
+@app.post("/bot{token}/{method}")
+async def bot_api(token: str, method: str, request: Request):
+    params = await read_params(request)
+    calls[method] += 1
+
+    if method == "getMe":
+        return ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+    if method in ("setWebhook", "deleteWebhook"):
+        return ok(True)
+    if method == "getUpdates":
+        await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 10))
+        return ok([])
+
+    delay = settings.latency_ms + random.uniform(-settings.jitter_ms, settings.jitter_ms)
+    await asyncio.sleep(max(delay, 0) / 1000)
+
+    if random.random() < settings.rate_429:
+        calls["429"] += 1
+        return JSONResponse(status_code=429, content={
+            "ok": False,
+            "error_code": 429,
+            "description": f"Too Many Requests: retry after {settings.retry_after}",
+            "parameters": {"retry_after": settings.retry_after},
+        })
+    if random.random() < settings.error_rate:
+        calls["502"] += 1
+        return JSONResponse(status_code=502, content={
+            "ok": False, "error_code": 502, "description": "Bad Gateway",
+        })
+
+    if method in ("sendMessage", "editMessageText"):
+        # Digests list several orders in one message
+        for order_id in ORDER_ID_RE.findall(params.get("text", "")):
+            deliveries.setdefault(order_id, []).append(time.time())
+        return ok(message(params))
+    return ok(True)
+
+
+@app.post("/auth")
+async def auth(request: Request):
+    params = await read_params(request)
+    calls["auth"] += 1
+    return {"Success": True, "username": params.get("username", "")}
+
+
+@app.get("/stats")
+async def stats():
+    return {"calls": dict(calls), "deliveries": deliveries}
+
+
+@app.post("/reset")
+async def reset():
+    calls.clear()
+    deliveries.clear()
+    return {"status": "ok"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=40.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 502")
+    args = parser.parse_args()
+    for key in vars(settings):
+        setattr(settings, key, getattr(args, key))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+﻿"""Load generator for end-to-end alert benchmarks.
+
+Seeds a users.db with N subscribers, fires /new_order and /auth_status
+payloads at the bot at a fixed rate and, using the delivery log of
+bench/fake_bot_api.py, reports throughput and webhook-to-delivery latency.
+
+    python -m bench.load_generator --seed-db bench.db --users 200 --traders 50
+    DB_NAME=bench.db TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot \
+        AUTH_ENDPOINT=http://127.0.0.1:8081/auth VALIDATE_SESSIONS=0 python main.py
+    python -m bench.load_generator --rate 50 --duration 30
+
+VALIDATE_SESSIONS=0 keeps the bot from re-checking (and deleting) the seeded
+users; AUTH_ENDPOINT points logins at fake_bot_api instead of the platform.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+
+
+def seed(path: str, users: int, traders: int):
+    """Create ``users`` subscribers spread over ``traders`` platform accounts."""
+    os.environ["DB_NAME"] = path
+    import database  # reads DB_NAME on import
+
+    database.init_db()
+    for index in range(users):
+        telegram_id = 10_000_000 + index
+        database.add_user(telegram_id, f"bench_user_{index}", trader_name(index % traders))
+        database.set_order_notification_status(telegram_id, True)
+        database.set_appeal_notification_status(telegram_id, True)
+    print(f"Seeded {users} users for {traders} traders into {path}")
+
+
+def trader_name(index: int) -> str:
+    return f"bench_trader_{index}"
+
+
+def order_payload(order_id: str, trader: str, appeal: bool) -> dict:
+    now = datetime.utcnow()
+    payload = {
+        "status": "appeal" if appeal else "order",
+        "username": trader,
+        "order_id": order_id,
+        "fiat_amount": random.choice([500, 1200, 2500, 10000]),
+        "currency": "uah",
+        "type": random.choice(["card", "iban", "oneclick"]),
+        "requisites_name": "Monobank",
+        "requisites_cardNumber": "5375414100001234",
+        "requisites_ibanAcc": "UA213223130000026007233566001",
+        "requisites_cardholderName": "Ivan",
+        "requisites_cardholderSurname": "Petrenko",
+        "UTC": 3,
+        "order_date_created": (now - timedelta(minutes=5)).strftime("%d.%m.%Y %H:%M:%S"),
+        "order_timer": 15,
+        "trader_rate": 41.2,
+        "trader_fee": 1.5,
+        "exchange_rate": 41.8,
+    }
+    if appeal:
+        payload["appeal_date_created"] = now.strftime("%d.%m.%Y %H:%M:%S")
+        payload["appeal_timer"] = 30
+    return payload
+
+
+def percentile(values, share: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def describe(name: str, seconds) -> str:
+    ms = [value * 1000 for value in seconds]
+    return (
+        f"{name}: n={len(ms)} p50={percentile(ms, 0.5):.1f}ms "
+        f"p95={percentile(ms, 0.95):.1f}ms p99={percentile(ms, 0.99):.1f}ms"
+    )
+
+
+async def run(args):
+    run_id = uuid.uuid4().hex[:6]
+    sent_at = {}
+    response_times = []
+    statuses = {}
+
+    async with httpx.AsyncClient(base_url=args.target, timeout=30) as client:
+        await client.post(f"{args.fake_api}/reset")
+
+        async def fire(seq: int):
+            trader = trader_name(random.randrange(args.traders))
+            if random.random() < args.auth_ratio:
+                path = "/auth_status"
+                payload = {"username": trader, "authentication_freeze": "false"}
+            else:
+                path = "/new_order"
+                order_id = f"bench-{run_id}-{seq}"
+                payload = order_payload(order_id, trader, random.random() < args.appeal_ratio)
+                sent_at[order_id] = time.time()
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, json=payload)
+                status = response.json().get("status", response.status_code)
+            except Exception as e:
+                status = type(e).__name__
+            response_times.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+        # Open-loop schedule: requests go out on time even if the bot is slow
+        tasks = []
+        total = int(args.rate * args.duration)
+        started = time.perf_counter()
+        for seq in range(total):
+            delay = started + seq / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(fire(seq)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+        await asyncio.sleep(args.drain)
+        stats = (await client.get(f"{args.fake_api}/stats")).json()
+
+    delivery_latency = []
+    for order_id, times in stats["deliveries"].items():
+        if order_id in sent_at:
+            delivery_latency.extend(at - sent_at[order_id] for at in times)
+
+    print(f"Requests: {total} in {elapsed:.1f}s ({total / elapsed:.1f}/s), statuses {statuses}")
+    print(f"Deliveries: {len(delivery_latency)} ({len(delivery_latency) / (elapsed + args.drain):.1f}/s)")
+    print(describe("Webhook response", response_times))
+    print(describe("Webhook to delivery", delivery_latency))
+    print(f"Fake Bot API calls: {stats['calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="bot FastAPI base URL")
+    parser.add_argument("--fake-api", default="http://127.0.0.1:8081", help="fake Bot API base URL")
+    parser.add_argument("--rate", type=float, default=20, help="events per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for deliveries")
+    parser.add_argument("--traders", type=int, default=50)
+    parser.add_argument("--appeal-ratio", type=float, default=0.2)
+    parser.add_argument("--auth-ratio", type=float, default=0.02)
+    parser.add_argument("--seed-db", help="seed this database file and exit")
+    parser.add_argument("--users", type=int, default=200, help="users to seed")
+    args = parser.parse_args()
+
+    if args.seed_db:
+        seed(args.seed_db, args.users, args.traders)
+        return
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
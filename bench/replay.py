@@ -0,0 +1,114 @@
+﻿"""Replay a webhook capture (CAPTURE_DIR) against a local bot instance.
+
+Preserves the recorded spacing between events, scaled by --speed
+(1 — real time, 10 — ten times faster, 0 — as fast as possible).
+
+    python -m bench.replay captures/ --speed 10 --unique-ids
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+import uuid
+
+import httpx
+
+from bench.load_generator import describe
+
+
+def capture_files(paths):
+    """Expand directories into their capture files, oldest first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, entry) for entry in os.listdir(path)
+                if entry.endswith((".jsonl", ".jsonl.gz"))
+            )
+        else:
+            files.append(path)
+    return sorted(files, key=os.path.basename)
+
+
+def read_records(files):
+    for name in files:
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(name, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def with_unique_ids(body: str, suffix: str) -> str:
+    """Suffix order ids so the bot's dedup does not swallow a second replay."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    for item in data if isinstance(data, list) else [data]:
+        if isinstance(item, dict) and item.get("order_id"):
+            item["order_id"] = f"{item['order_id']}-{suffix}"
+    return json.dumps(data, ensure_ascii=False)
+
+
+async def replay(args):
+    suffix = uuid.uuid4().hex[:6]
+    response_times = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.target, timeout=30) as client:
+
+        async def send(record):
+            body = record["body"]
+            if args.unique_ids:
+                body = with_unique_ids(body, suffix)
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(
+                        record["path"],
+                        content=body.encode(),
+                        headers={"Content-Type": "application/json"},
+                    )
+                    status = response.status_code
+                except Exception as e:
+                    status = type(e).__name__
+                response_times.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+        tasks = []
+        first_ts = None
+        started = time.perf_counter()
+        for record in read_records(capture_files(args.captures)):
+            if first_ts is None:
+                first_ts = record["ts"]
+            if args.speed > 0:
+                delay = started + (record["ts"] - first_ts) / args.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(record)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    if not tasks:
+        print("No captured events found")
+        return
+    print(f"Replayed {len(tasks)} events in {elapsed:.1f}s ({len(tasks) / elapsed:.1f}/s), statuses {statuses}")
+    print(describe("Webhook response", response_times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("captures", nargs="+", help="capture files or directories")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="bot FastAPI base URL")
+    parser.add_argument("--speed", type=float, default=1, help="time scale, 0 — no delays")
+    parser.add_argument("--concurrency", type=int, default=100, help="requests in flight")
+    parser.add_argument("--unique-ids", action="store_true", help="suffix order ids per replay")
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
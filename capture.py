@@ -0,0 +1,93 @@
+﻿import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from config import CAPTURE_DIR, CAPTURE_ROTATE_BYTES, CAPTURE_MAX_FILES
+
+logger = logging.getLogger(__name__)
+
+
+class EventCapture:
+    """Append-only log of raw platform webhooks for bench/replay.py.
+
+    Each line is ``{"ts": <unix time>, "path": <route>, "body": <raw body>}``.
+    The active file ``capture-<start>.jsonl`` is rotated once it grows past
+    ``rotate_bytes``; rotated files are gzipped in a background thread and
+    only the newest ``max_files`` of them are kept.
+    """
+
+    def __init__(self, directory: str, rotate_bytes: int, max_files: int):
+        self.directory = directory
+        self.rotate_bytes = rotate_bytes
+        self.max_files = max_files
+        self._file = None
+        self._size = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def record(self, path: str, body: bytes):
+        if not self.enabled:
+            return
+        line = json.dumps(
+            {"ts": time.time(), "path": path, "body": body.decode("utf-8", "replace")},
+            ensure_ascii=False,
+        ).encode() + b"\n"
+        try:
+            if self._file is None:
+                self._open()
+            self._file.write(line)
+            self._file.flush()
+            self._size += len(line)
+            if self._size >= self.rotate_bytes:
+                self.rotate()
+        except OSError as e:
+            logger.error(f"Failed to capture webhook {path}: {e}")
+
+    def rotate(self):
+        """Close the active file and compress it in the background."""
+        if self._file is None:
+            return
+        name = self._file.name
+        self._file.close()
+        self._file = None
+        self._size = 0
+        threading.Thread(target=self._compress, args=(name,), daemon=True).start()
+
+    def close(self):
+        if self._file is None:
+            return
+        name = self._file.name
+        self._file.close()
+        self._file = None
+        self._compress(name)
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+        self._file = open(os.path.join(self.directory, f"capture-{stamp}.jsonl"), "xb")
+        self._size = 0
+
+    def _compress(self, name: str):
+        try:
+            with open(name, "rb") as src, gzip.open(name + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(name)
+        except OSError as e:
+            logger.error(f"Failed to compress capture {name}: {e}")
+            return
+
+        archives = sorted(
+            entry for entry in os.listdir(self.directory) if entry.endswith(".jsonl.gz")
+        )
+        for entry in archives[:-self.max_files] if self.max_files > 0 else []:
+            os.remove(os.path.join(self.directory, entry))
+
+
+capture = EventCapture(CAPTURE_DIR, CAPTURE_ROTATE_BYTES, CAPTURE_MAX_FILES)
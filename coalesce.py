@@ -0,0 +1,104 @@
+﻿import asyncio
+import logging
+import time
+
+from alerts import render_digest
+from config import ALERT_COALESCE_WINDOW
+from db_async import save_sent_alert
+from metrics import ALERT_LATENCY
+from send_scheduler import scheduler, PRIORITY_ORDER, PRIORITY_APPEAL
+
+logger = logging.getLogger(__name__)
+
+
+def alert_priority(status: str) -> int:
+    return PRIORITY_ORDER if status == "order" else PRIORITY_APPEAL
+
+
+class AlertCoalescer:
+    """Merges alerts that reach one chat within ``window`` seconds.
+
+    The first alert for a chat is not held: the caller sends it right away
+    and it opens a window. Alerts arriving while the window is open are held
+    and sent when it closes — as they are if only one arrived, otherwise as a
+    single digest. A flush opens the next window, so a sustained burst costs
+    one message per window instead of one per order.
+
+    Held alerts live only in memory, so the caller awaits the future
+    returned by ``hold()``: it resolves to the sent message, or raises the
+    send error, and only then may the alert be reported as delivered.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._held = {}  # chat_id -> [(event, rendered, future)] while its window is open
+        self._tasks = set()
+
+    def hold(self, bot, chat_id: int, event, rendered) -> asyncio.Future | None:
+        """Hold the alert back for the chat's next flush.
+
+        Returns the future of the flush, or None if the caller should send
+        the alert itself.
+        """
+        if self.window <= 0:
+            return None
+        held = self._held.get(chat_id)
+        if held is None:
+            self._open(bot, chat_id)
+            return None
+        future = asyncio.get_running_loop().create_future()
+        held.append((event, rendered, future))
+        return future
+
+    def _open(self, bot, chat_id: int):
+        self._held[chat_id] = []
+        asyncio.get_running_loop().call_later(self.window, self._close, bot, chat_id)
+
+    def _close(self, bot, chat_id: int):
+        held = self._held.pop(chat_id, None)
+        if not held:
+            return
+        self._open(bot, chat_id)
+        task = asyncio.create_task(self._flush(bot, chat_id, held))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, bot, chat_id: int, held):
+        events = [event for event, _, _ in held]
+        futures = [future for _, _, future in held]
+        if len(held) == 1:
+            rendered = held[0][1]
+        else:
+            rendered = render_digest(events)
+        try:
+            message = await scheduler.send_message(
+                bot, chat_id, alert_priority(rendered.status), **rendered.send_kwargs()
+            )
+        except Exception as e:
+            logger.error(f"Failed to send {len(events)} coalesced alerts to {chat_id}: {e}")
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # A single held alert is edited by /order_update like any other; a
+        # digest is not, its footer would apply to every order it lists
+        if len(events) == 1:
+            event = events[0]
+            try:
+                await save_sent_alert(
+                    event.order_id, chat_id, message.message_id, event.status, rendered.text
+                )
+            except Exception as e:
+                # The alert is delivered, only later edits of it are lost
+                logger.error(f"Failed to index alert {event.order_id} for user {chat_id}: {e}")
+        for future in futures:
+            if not future.done():
+                future.set_result(message)
+        now = time.time()
+        for event in events:
+            if event.received_at:
+                ALERT_LATENCY.observe(now - event.received_at, event.status)
+        logger.info(f"Sent {len(events)} coalesced alerts to user {chat_id}")
+
+
+coalescer = AlertCoalescer(ALERT_COALESCE_WINDOW)
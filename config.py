@@ -10,6 +10,8 @@ ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
 USE_MOCK = False  # True — use mock data, False — real API requests
 AUTH_ENDPOINT = os.getenv("AUTH_ENDPOINT", "https://tradeacclogin.click/api/v1/telegram/trader/orderalert/AuthHandler.ashx")
 ADMIN_USERNAMES = {"ddenuxe", "Konvert_support_Di"}
+# Daily re-check of active sessions against AUTH_ENDPOINT, "0" — off (benchmarks)
+VALIDATE_SESSIONS = os.getenv("VALIDATE_SESSIONS", "1") != "0"
 
 SUPPORT_CONTACT = "@konvert_pm"
 
@@ -20,7 +22,86 @@ password_attempts = {}
 user_states = {}  # Track user states
 
 # Database configuration
-DB_NAME = "users.db"
+DB_NAME = os.getenv("DB_NAME", "users.db")
+# Per-connection tuning, see database.connect()
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))  # bytes
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))  # seconds
+SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "256"))
+# Threads running queries for async code (db_async.py)
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))
+
+# Webhook delivery
+# Maximum number of Telegram sends running at once for a single event fan-out
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "10"))
+# "inline" — send inside the webhook request, "queue" — enqueue and answer 202,
+# "outbox" — persist to the outbox table and answer 202
+WEBHOOK_DELIVERY_MODE = os.getenv("WEBHOOK_DELIVERY_MODE", "inline")
+# Number of delivery workers; jobs for one chat always go to the same worker
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "4"))
+# Maximum pending jobs per worker before the webhook answers 503
+DELIVERY_QUEUE_SIZE = int(os.getenv("DELIVERY_QUEUE_SIZE", "1000"))
+
+# Outbox dispatcher (WEBHOOK_DELIVERY_MODE = "outbox")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2.0"))  # seconds
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))  # seconds
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "24"))
+
+# Deduplication of platform webhook retries
+DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", "3600"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+
+# Sent alert messages are kept this long so /order_update can edit them
+SENT_ALERT_RETENTION_HOURS = float(os.getenv("SENT_ALERT_RETENTION_HOURS", "72"))
+
+# Recently alerted orders kept in memory for the "Details" button
+ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "10000"))
+# Platform lookup for orders missing from the cache, empty — disabled
+ORDER_DETAILS_ENDPOINT = os.getenv("ORDER_DETAILS_ENDPOINT", "")
+ORDER_DETAILS_TIMEOUT = float(os.getenv("ORDER_DETAILS_TIMEOUT", "3"))  # seconds
+# Failed or empty platform lookups are not repeated for this long
+ORDER_DETAILS_MISS_TTL = float(os.getenv("ORDER_DETAILS_MISS_TTL", "60"))  # seconds
+
+# Merge alerts reaching one chat within this many seconds into a digest, 0 — off.
+# Inline delivery only: the webhook answers once the digest is sent
+ALERT_COALESCE_WINDOW = float(os.getenv("ALERT_COALESCE_WINDOW", "0"))
+
+# Capture of raw platform webhooks for bench/replay.py, empty — disabled
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "")
+CAPTURE_ROTATE_BYTES = int(os.getenv("CAPTURE_ROTATE_BYTES", str(64 * 1024 * 1024)))
+CAPTURE_MAX_FILES = int(os.getenv("CAPTURE_MAX_FILES", "48"))  # compressed files kept
+
+# Outgoing Telegram rate limits (messages per second)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_PER_CHAT_RATE = float(os.getenv("TG_PER_CHAT_RATE", "1"))
+TG_PER_CHAT_BURST = int(os.getenv("TG_PER_CHAT_BURST", "3"))
+# Retries of transient Telegram errors (RetryAfter always waits the advised delay)
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+TG_RETRY_BACKOFF_BASE = float(os.getenv("TG_RETRY_BACKOFF_BASE", "1.0"))  # seconds
+TG_RETRY_BACKOFF_MAX = float(os.getenv("TG_RETRY_BACKOFF_MAX", "60"))  # seconds
+
+# Shared Telegram HTTP client
+TG_CONNECTION_POOL_SIZE = int(os.getenv("TG_CONNECTION_POOL_SIZE", "64"))
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "5"))  # seconds
+TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "10"))  # seconds
+TG_WRITE_TIMEOUT = float(os.getenv("TG_WRITE_TIMEOUT", "10"))  # seconds
+TG_POOL_TIMEOUT = float(os.getenv("TG_POOL_TIMEOUT", "3"))  # seconds
+# Idle keep-alive connection lifetime in seconds, empty — httpx default
+TG_KEEPALIVE_EXPIRY = os.getenv("TG_KEEPALIVE_EXPIRY", "")
+# "1.1" or "2" (HTTP/2 needs the httpx[http2] extra)
+TG_HTTP_VERSION = os.getenv("TG_HTTP_VERSION", "1.1")
+# Bot API base URL, point it at bench/fake_bot_api.py for offline benchmarks
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+
+# Incoming Telegram updates: "polling" or "webhook" (served by the FastAPI app
+# at /telegram/<TELEGRAM_WEBHOOK_SECRET>)
+TELEGRAM_UPDATES_MODE = os.getenv("TELEGRAM_UPDATES_MODE", "polling")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")  # public base URL, e.g. https://bot.example.com
+# Used both in the path and as the secret_token header; allowed characters: A-Z a-z 0-9 _ -
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
 
 # Information file
 INFO_FILE = "bot_info.json"
@@ -75,3 +156,4 @@ BACK_TO_MAIN = "back_to_main"
 BACK_TO_PROFILE = "back_to_profile"
 BAN_USER_PREFIX = "ban_user_"
 PROMOTE_USER_PREFIX = "promote_user_"
+ORDER_DETAILS_PREFIX = "order_"
@@ -1,43 +1,202 @@
 ﻿import sqlite3
 import logging
-from config import DB_NAME, ADMIN_USERNAMES
+import threading
+import time
+from functools import wraps
+from typing import NamedTuple
+from config import (
+    DB_NAME, ADMIN_USERNAMES,
+    SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT, SQLITE_CACHED_STATEMENTS,
+)
+from metrics import observe_db
+from user_cache import user_cache, UserRecord, username_key
 
 logger = logging.getLogger(__name__)
 
+_local = threading.local()
+
+
+def connect() -> sqlite3.Connection:
+    """Return this thread's connection to DB_NAME, opening it on first use.
+
+    The connection is reused by every function below, so calls skip the
+    file open and schema parse and hit sqlite3's prepared statement cache.
+    Used as ``with connect() as conn:`` which commits or rolls back but
+    keeps the connection open.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            DB_NAME,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+        )
+        # WAL lets readers run alongside a writer; NORMAL is durable in WAL
+        # mode except for the last transactions on power loss
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        _local.conn = conn
+    return conn
+
+
+def close_connection():
+    """Close this thread's connection, e.g. on shutdown."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+def _writes_users(func):
+    """Run a users table writer under the user cache's write lock.
+
+    Its commit and the matching cache change then happen together, so the
+    cache applies concurrent writes to a user in the order SQLite did.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with user_cache.write_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Schema migrations: MIGRATIONS[n] upgrades a database at PRAGMA user_version
+# n to n + 1. Append new steps, never edit ones that were released.
+
+def _add_column(cursor, table: str, column: str, definition: str):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _migrate_baseline(cursor):
+    """Schema as of the first versioned release; also upgrades older files."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            tg_username TEXT,
+            platform_username TEXT,
+            notifications_enabled INTEGER DEFAULT 0,
+            appeal_notifications_enabled INTEGER DEFAULT 0,
+            role TEXT DEFAULT 'user',
+            banned INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (state, next_attempt_at)"
+    )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_events (
+            order_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (order_id, status, recipient)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sent_alerts (
+            order_id TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            text TEXT NOT NULL,
+            sent_at REAL NOT NULL,
+            PRIMARY KEY (order_id, chat_id)
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sent_alerts_sent_at ON sent_alerts (sent_at)"
+    )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_details (
+            order_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_order_details_updated_at ON order_details (updated_at)"
+    )
+    # На случай, если обновляем старую БД
+    _add_column(cursor, "users", "role", "TEXT DEFAULT 'user'")
+    _add_column(cursor, "users", "banned", "INTEGER DEFAULT 0")
+    _add_column(cursor, "users", "appeal_notifications_enabled", "INTEGER DEFAULT 0")
+
+
+def _migrate_username_index(cursor):
+    """Case-insensitive, partial covering index for the webhook recipient lookups."""
+    cursor.execute("DROP INDEX IF EXISTS idx_users_platform_username")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_active_platform_username ON users ("
+        "lower(platform_username), telegram_id, platform_username, "
+        "notifications_enabled, appeal_notifications_enabled, banned"
+        ") WHERE banned = 0"
+    )
+
+
+def _migrate_drop_raw_order_details(cursor):
+    """Rows written before payloads were masked hold full card numbers; the table is a cache."""
+    cursor.execute("DELETE FROM order_details")
+
+
+MIGRATIONS = [
+    _migrate_baseline,
+    _migrate_username_index,
+    _migrate_drop_raw_order_details,
+]
+
+
+@observe_db
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
+    """Apply the pending migrations, one transaction per step."""
+    with connect() as conn:
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                break
+            MIGRATIONS[version](conn.cursor())
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+            logger.info(f"Database migrated to version {version + 1}")
+
+@observe_db
+@_writes_users
+def load_user_cache():
+    """Read the users table into the in-memory user cache."""
+    with connect() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE,
-                tg_username TEXT,
-                platform_username TEXT,
-                notifications_enabled INTEGER DEFAULT 0,
-                appeal_notifications_enabled INTEGER DEFAULT 0,
-                role TEXT DEFAULT 'user',
-                banned INTEGER DEFAULT 0
-            )
-        ''')
-        # На случай, если обновляем старую БД
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")
-        except sqlite3.OperationalError:
-            pass
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN banned INTEGER DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass
-        try:
-            cursor.execute(
-                "ALTER TABLE users ADD COLUMN appeal_notifications_enabled INTEGER DEFAULT 0"
-            )
-        except sqlite3.OperationalError:
-            pass
-        conn.commit()
+        cursor.execute(
+            "SELECT id, telegram_id, tg_username, platform_username, notifications_enabled, "
+            "appeal_notifications_enabled, role, banned FROM users"
+        )
+        user_cache.load(cursor.fetchall())
+    logger.info("Loaded users into the user cache")
 
+@observe_db
+@_writes_users
 def add_user(telegram_id, tg_username, platform_username):
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
 
         # Сначала удалить если уже есть
@@ -51,31 +210,64 @@ def add_user(telegram_id, tg_username, platform_username):
         ''', (telegram_id, tg_username, platform_username, role))
 
         conn.commit()
+    user_cache.put(
+        UserRecord(cursor.lastrowid, telegram_id, tg_username, platform_username, 0, 0, role, 0)
+    )
 
 
 
+@observe_db
 def is_admin(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return record is not None and record.role == 'admin'
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT role FROM users WHERE telegram_id = ?', (telegram_id,))
         row = cursor.fetchone()
         return row and row[0] == 'admin'
 
+@observe_db
 def get_all_users():
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT telegram_id, tg_username, role, banned FROM users")
         return cursor.fetchall()
 
+@observe_db
 def get_user_by_id(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return record.as_row() if record else None
+    with connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+        cursor.execute(
+            "SELECT id, telegram_id, tg_username, platform_username, notifications_enabled, "
+            "appeal_notifications_enabled, role, banned FROM users WHERE telegram_id = ?",
+            (telegram_id,),
+        )
         return cursor.fetchone()
 
+@observe_db
+def get_user_record(telegram_id):
+    """The user's row as a UserRecord, None if the user is not registered."""
+    if user_cache.loaded:
+        return user_cache.get(telegram_id)
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, telegram_id, tg_username, platform_username, notifications_enabled, "
+            "appeal_notifications_enabled, role, banned FROM users WHERE telegram_id = ?",
+            (telegram_id,),
+        )
+        row = cursor.fetchone()
+        return UserRecord(*row) if row else None
+
+@observe_db
+@_writes_users
 def ban_user_by_id(telegram_id):
     """Mark the user as banned and disable all notifications."""
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE users SET banned = 1, notifications_enabled = 0, "
@@ -83,36 +275,55 @@ def ban_user_by_id(telegram_id):
             (telegram_id,),
         )
         conn.commit()
+    user_cache.update(
+        telegram_id, banned=1, notifications_enabled=0, appeal_notifications_enabled=0
+    )
 
+@observe_db
+@_writes_users
 def unban_user_by_id(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE users SET banned = 0 WHERE telegram_id = ?", (telegram_id,))
         conn.commit()
+    user_cache.update(telegram_id, banned=0)
 
+@observe_db
+@_writes_users
 def update_platform_username(telegram_id, new_username):
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE users SET platform_username = ? WHERE telegram_id = ?", (new_username, telegram_id))
         conn.commit()
+    user_cache.update(telegram_id, platform_username=new_username)
 
+@observe_db
+@_writes_users
 def promote_to_admin(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE users SET role = 'admin' WHERE telegram_id = ?", (telegram_id,))
         conn.commit()
+    user_cache.update(telegram_id, role='admin')
 
+@observe_db
+@_writes_users
 def set_order_notification_status(telegram_id, status):
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE users SET notifications_enabled = ? WHERE telegram_id = ?",
             (1 if status else 0, telegram_id),
         )
         conn.commit()
+    user_cache.update(telegram_id, notifications_enabled=1 if status else 0)
 
+@observe_db
 def get_order_notification_status(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return bool(record.notifications_enabled) if record else False
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT notifications_enabled FROM users WHERE telegram_id = ?",
@@ -121,17 +332,24 @@ def get_order_notification_status(telegram_id):
         row = cursor.fetchone()
         return bool(row[0]) if row else False
 
+@observe_db
+@_writes_users
 def set_appeal_notification_status(telegram_id, status):
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE users SET appeal_notifications_enabled = ? WHERE telegram_id = ?",
             (1 if status else 0, telegram_id),
         )
         conn.commit()
+    user_cache.update(telegram_id, appeal_notifications_enabled=1 if status else 0)
 
+@observe_db
 def get_appeal_notification_status(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return bool(record.appeal_notifications_enabled) if record else False
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT appeal_notifications_enabled FROM users WHERE telegram_id = ?",
@@ -140,97 +358,222 @@ def get_appeal_notification_status(telegram_id):
         row = cursor.fetchone()
         return bool(row[0]) if row else False
 
+@observe_db
 def get_notification_status(telegram_id):
     """Legacy wrapper for order notifications."""
     return get_order_notification_status(telegram_id)
 
 
+@observe_db
 def is_user_banned(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return bool(record.banned) if record else False
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT banned FROM users WHERE telegram_id = ?", (telegram_id,))
         row = cursor.fetchone()
         return bool(row[0]) if row else False
 
+@observe_db
+@_writes_users
 def delete_user(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
         conn.commit()
+    user_cache.remove(telegram_id)
 
+@observe_db
 def get_platform_username(telegram_id):
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return record.platform_username if record else None
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT platform_username FROM users WHERE telegram_id = ?", (telegram_id,))
         row = cursor.fetchone()
         return row[0] if row else None
 
+@observe_db
 def get_user_stats():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        
-        # Total users
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        # Active users (not banned)
-        cursor.execute("SELECT COUNT(*) FROM users WHERE banned = 0")
-        active_users = cursor.fetchone()[0]
-        
-        # Banned users
-        cursor.execute("SELECT COUNT(*) FROM users WHERE banned = 1")
-        banned_users = cursor.fetchone()[0]
-        
-        # Admin users
-        cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'admin'")
-        admin_users = cursor.fetchone()[0]
-        
-       # Users with order notifications enabled
-        cursor.execute("SELECT COUNT(*) FROM users WHERE notifications_enabled = 1")
-        order_enabled = cursor.fetchone()[0]
-
-        # Users with appeal notifications enabled
-        cursor.execute("SELECT COUNT(*) FROM users WHERE appeal_notifications_enabled = 1")
-        appeal_enabled = cursor.fetchone()[0]
-        
+    """User counts for the admin stats view.
+
+    Kept up to date by the user cache once it is loaded; otherwise counted
+    in a single pass over the table.
+    """
+    if user_cache.loaded:
+        return user_cache.stats()
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT COUNT(*), "
+            "COALESCE(SUM(banned = 0), 0), "
+            "COALESCE(SUM(banned = 1), 0), "
+            "COALESCE(SUM(role = 'admin'), 0), "
+            "COALESCE(SUM(notifications_enabled = 1), 0), "
+            "COALESCE(SUM(appeal_notifications_enabled = 1), 0) "
+            "FROM users"
+        )
+        total, active, banned, admin, order_enabled, appeal_enabled = cursor.fetchone()
         return {
-            "total": total_users,
-            "active": active_users,
-            "banned": banned_users,
-            "admin": admin_users,
+            "total": total,
+            "active": active,
+            "banned": banned,
+            "admin": admin,
             "order_notifications_enabled": order_enabled,
             "appeal_notifications_enabled": appeal_enabled
         }
+
+@observe_db
 def get_active_user_sessions():
     """Return list of active (not banned) user sessions."""
-    with sqlite3.connect(DB_NAME) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT telegram_id, tg_username, platform_username FROM users WHERE banned = 0"
         )
         return cursor.fetchall()
 
+@observe_db
 def get_user_ids_by_platform_username(platform_username: str) -> list[int]:
     """Return all active Telegram IDs for the given platform username."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        return [
+            record.telegram_id
+            for record in user_cache.by_platform_username(platform_username)
+            if record.banned == 0
+        ]
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            "SELECT telegram_id FROM users WHERE platform_username = ? AND banned = 0",
-            (platform_username,),
+            "SELECT telegram_id FROM users "
+            "WHERE lower(platform_username) = ? AND banned = 0 ORDER BY telegram_id",
+            (username_key(platform_username),),
         )
         rows = cursor.fetchall()
         return [row[0] for row in rows]
 
 
+class Recipient(NamedTuple):
+    """Snapshot of everything the alert path needs to know about a recipient."""
+    telegram_id: int
+    order_enabled: bool
+    appeal_enabled: bool
+    banned: bool
+
+    def wants(self, status: str) -> bool:
+        """Return True if the recipient should receive an alert of this status."""
+        if self.banned:
+            return False
+        if status == "order":
+            return self.order_enabled
+        if status == "appeal":
+            return self.appeal_enabled
+        return False
+
+
+def _recipient(record: UserRecord) -> Recipient:
+    return Recipient(
+        record.telegram_id,
+        bool(record.notifications_enabled),
+        bool(record.appeal_notifications_enabled),
+        bool(record.banned),
+    )
+
+
+@observe_db
+def get_notification_recipients(platform_username: str) -> list[Recipient]:
+    """Return active recipients for the platform username in a single query."""
+    if user_cache.loaded:
+        return [
+            _recipient(record)
+            for record in user_cache.by_platform_username(platform_username)
+            if record.banned == 0
+        ]
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT telegram_id, notifications_enabled, appeal_notifications_enabled, banned "
+            "FROM users WHERE lower(platform_username) = ? AND banned = 0 ORDER BY telegram_id",
+            (username_key(platform_username),),
+        )
+        return [
+            Recipient(row[0], bool(row[1]), bool(row[2]), bool(row[3]))
+            for row in cursor.fetchall()
+        ]
+
+
+@observe_db
+def get_notification_recipients_bulk(platform_usernames) -> dict[str, list[Recipient]]:
+    """Return active recipients for many platform usernames in one pass."""
+    usernames = list(dict.fromkeys(platform_usernames))
+    result = {username: [] for username in usernames}
+    if user_cache.loaded:
+        for username in usernames:
+            result[username] = [
+                _recipient(record)
+                for record in user_cache.by_platform_username(username)
+                if record.banned == 0
+            ]
+        return result
+    # Usernames differing only in case share the same recipients
+    by_key = {}
+    for username in usernames:
+        by_key.setdefault(username_key(username), []).append(username)
+    keys = list(by_key)
+    with connect() as conn:
+        cursor = conn.cursor()
+        # Stay well below SQLite's limit on bound parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            cursor.execute(
+                "SELECT platform_username, telegram_id, notifications_enabled, "
+                "appeal_notifications_enabled, banned FROM users "
+                f"WHERE lower(platform_username) IN ({placeholders}) AND banned = 0",
+                chunk,
+            )
+            for row in cursor.fetchall():
+                recipient = Recipient(row[1], bool(row[2]), bool(row[3]), bool(row[4]))
+                for username in by_key[username_key(row[0])]:
+                    result[username].append(recipient)
+    return result
+
+
+@observe_db
+def get_recipient(telegram_id: int):
+    """Return the Recipient snapshot for a single Telegram ID or None."""
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return _recipient(record) if record else None
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT telegram_id, notifications_enabled, appeal_notifications_enabled, banned "
+            "FROM users WHERE telegram_id = ?",
+            (telegram_id,),
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return Recipient(row[0], bool(row[1]), bool(row[2]), bool(row[3]))
+
+
+@observe_db
 def get_user_id_by_platform_username(platform_username: str):
     """Return the first active Telegram ID for compatibility."""
     ids = get_user_ids_by_platform_username(platform_username)
     return ids[0] if ids else None
 
 
+@observe_db
 def is_user_authorized(telegram_id: int) -> bool:
     """Check if the user exists and is not banned."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return record is not None and record.banned == 0
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT banned FROM users WHERE telegram_id = ?",
@@ -240,9 +583,13 @@ def is_user_authorized(telegram_id: int) -> bool:
         return row is not None and row[0] == 0
 
 
+@observe_db
 def is_user_authorized(telegram_id: int) -> bool:
     """Check if the user exists and is not banned."""
-    with sqlite3.connect(DB_NAME) as conn:
+    if user_cache.loaded:
+        record = user_cache.get(telegram_id)
+        return record is not None and record.banned == 0
+    with connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT banned FROM users WHERE telegram_id = ?",
@@ -251,6 +598,254 @@ def is_user_authorized(telegram_id: int) -> bool:
         row = cursor.fetchone()
         return row is not None and row[0] == 0
 
+# Outbox: alerts waiting for delivery, persisted next to the users table.
+# Rows move pending -> sending -> delivered, or back to pending with a later
+# next_attempt_at on failure, or to dead once the attempts are exhausted.
+
+@observe_db
+def enqueue_outbox(chat_ids, kind: str, payload: str) -> int:
+    """Store one outbox row per chat in a single transaction."""
+    now = time.time()
+    with connect() as conn:
+        conn.executemany(
+            "INSERT INTO outbox (chat_id, kind, payload, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(chat_id, kind, payload, now, now) for chat_id in chat_ids],
+        )
+        conn.commit()
+    return len(chat_ids)
+
+
+@observe_db
+def claim_outbox_batch(limit: int) -> list[tuple]:
+    """Mark up to ``limit`` due rows as sending and return them.
+
+    Each row is ``(id, chat_id, kind, payload, attempts, created_at)``.
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(
+            "SELECT id, chat_id, kind, payload, attempts, created_at FROM outbox "
+            "WHERE state = 'pending' AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at, id LIMIT ?",
+            (time.time(), limit),
+        )
+        rows = cursor.fetchall()
+        if rows:
+            cursor.executemany(
+                "UPDATE outbox SET state = 'sending' WHERE id = ?",
+                [(row[0],) for row in rows],
+            )
+        conn.commit()
+        return rows
+
+
+@observe_db
+def finish_outbox_batch(delivered, retries, dead, deferred=()):
+    """Record the outcome of a claimed batch in a single transaction.
+
+    ``delivered`` is a list of ids, ``retries`` a list of
+    ``(id, next_attempt_at, error)`` and ``dead`` a list of ``(id, error)``.
+    ``deferred`` rows, ``(id, next_attempt_at)``, were not attempted and
+    keep their attempt count.
+    """
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "UPDATE outbox SET state = 'delivered', attempts = attempts + 1 WHERE id = ?",
+            [(row_id,) for row_id in delivered],
+        )
+        cursor.executemany(
+            "UPDATE outbox SET state = 'pending', attempts = attempts + 1, "
+            "next_attempt_at = ?, last_error = ? WHERE id = ?",
+            [(next_at, error, row_id) for row_id, next_at, error in retries],
+        )
+        cursor.executemany(
+            "UPDATE outbox SET state = 'dead', attempts = attempts + 1, last_error = ? "
+            "WHERE id = ?",
+            [(error, row_id) for row_id, error in dead],
+        )
+        cursor.executemany(
+            "UPDATE outbox SET state = 'pending', next_attempt_at = ? WHERE id = ?",
+            [(next_at, row_id) for row_id, next_at in deferred],
+        )
+        conn.commit()
+
+
+@observe_db
+def release_outbox_claims():
+    """Return rows left in 'sending' by a previous process to the queue."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE outbox SET state = 'pending' WHERE state = 'sending'")
+        conn.commit()
+        return cursor.rowcount
+
+
+@observe_db
+def purge_outbox(older_than: float):
+    """Delete delivered rows created before the given timestamp."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM outbox WHERE state = 'delivered' AND created_at < ?",
+            (older_than,),
+        )
+        conn.commit()
+        return cursor.rowcount
+
+
+# Processed events: (order_id, status, recipient) keys of webhook events that
+# were already delivered, used to drop platform retries.
+
+@observe_db
+def save_processed_events(keys, expires_at: float):
+    """Remember delivered event keys until ``expires_at``."""
+    with connect() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO processed_events (order_id, status, recipient, expires_at) "
+            "VALUES (?, ?, ?, ?)",
+            [(order_id, status, recipient, expires_at) for order_id, status, recipient in keys],
+        )
+        conn.commit()
+
+
+@observe_db
+def load_processed_events(limit: int) -> list[tuple]:
+    """Drop expired keys and return up to ``limit`` of the most recent ones.
+
+    Each row is ``(order_id, status, recipient, expires_at)``, oldest first.
+    """
+    now = time.time()
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM processed_events WHERE expires_at <= ?", (now,))
+        cursor.execute(
+            "SELECT order_id, status, recipient, expires_at FROM ("
+            "SELECT * FROM processed_events ORDER BY expires_at DESC LIMIT ?"
+            ") ORDER BY expires_at",
+            (limit,),
+        )
+        rows = cursor.fetchall()
+        conn.commit()
+        return rows
+
+
+@observe_db
+def purge_processed_events(now: float) -> int:
+    """Delete keys that expired before ``now``, return how many."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM processed_events WHERE expires_at <= ?", (now,))
+        conn.commit()
+        return cursor.rowcount
+
+
+# Sent alerts: the latest alert message per (order_id, chat_id), used to
+# edit it in place when the platform reports an order update.
+
+class SentAlert(NamedTuple):
+    order_id: str
+    chat_id: int
+    message_id: int
+    status: str
+    text: str
+
+
+@observe_db
+def save_sent_alert(order_id: str, chat_id: int, message_id: int, status: str, text: str):
+    """Remember the alert message sent (or last edited) for the order and chat."""
+    with connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sent_alerts "
+            "(order_id, chat_id, message_id, status, text, sent_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (order_id, chat_id, message_id, status, text, time.time()),
+        )
+        conn.commit()
+
+
+@observe_db
+def get_sent_alerts(order_id: str) -> list[SentAlert]:
+    """Return the alert messages sent for the order, one per chat."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT order_id, chat_id, message_id, status, text "
+            "FROM sent_alerts WHERE order_id = ?",
+            (order_id,),
+        )
+        return [SentAlert(*row) for row in cursor.fetchall()]
+
+
+@observe_db
+def get_sent_alert(order_id: str, chat_id: int):
+    """Return the SentAlert for the order in one chat or None."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT order_id, chat_id, message_id, status, text "
+            "FROM sent_alerts WHERE order_id = ? AND chat_id = ?",
+            (order_id, chat_id),
+        )
+        row = cursor.fetchone()
+        return SentAlert(*row) if row else None
+
+
+@observe_db
+def purge_sent_alerts(older_than: float) -> int:
+    """Forget alerts sent before ``older_than``; they can no longer be edited."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM sent_alerts WHERE sent_at < ?", (older_than,))
+        conn.commit()
+        return cursor.rowcount
+
+
+# Order details: the last alert payload and lifecycle status per order,
+# persistent fallback of the in-memory order cache.
+
+@observe_db
+def save_order_details(order_id: str, status: str, payload: str):
+    with connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO order_details (order_id, status, payload, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            (order_id, status, payload, time.time()),
+        )
+        conn.commit()
+
+
+@observe_db
+def update_order_details_status(order_id: str, status: str):
+    with connect() as conn:
+        conn.execute(
+            "UPDATE order_details SET status = ?, updated_at = ? WHERE order_id = ?",
+            (status, time.time(), order_id),
+        )
+        conn.commit()
+
+
+@observe_db
+def get_order_details(order_id: str):
+    """Return ``(status, payload)`` stored for the order or None."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT status, payload FROM order_details WHERE order_id = ?", (order_id,)
+        )
+        return cursor.fetchone()
+
+
+@observe_db
+def purge_order_details(older_than: float) -> int:
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM order_details WHERE updated_at < ?", (older_than,))
+        conn.commit()
+        return cursor.rowcount
+
+
 # Функция для добавления тестовых пользователей
 def add_test_users():
     # Добавляем тестового админа
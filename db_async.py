@@ -0,0 +1,81 @@
+﻿import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+import database
+from config import DB_THREADS
+from database import Recipient, SentAlert
+from user_cache import user_cache
+
+# Async counterparts of the database.py functions for handlers, webhook routes
+# and workers. Queries run on a small thread pool so a slow one never blocks
+# the event loop shared by uvicorn, PTB and the delivery workers; each pool
+# thread keeps its own connection and WAL lets readers run beside a writer.
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+async def run(func, *args, **kwargs):
+    """Run a blocking database function on the DB thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+def _async(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+def _cached(func):
+    # Answered from the user cache once it is loaded: a dict lookup is
+    # cheaper than the hop to the thread pool
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if user_cache.loaded:
+            return func(*args, **kwargs)
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+add_user = _async(database.add_user)
+is_admin = _cached(database.is_admin)
+get_all_users = _async(database.get_all_users)
+get_user_by_id = _cached(database.get_user_by_id)
+get_user_record = _cached(database.get_user_record)
+ban_user_by_id = _async(database.ban_user_by_id)
+unban_user_by_id = _async(database.unban_user_by_id)
+update_platform_username = _async(database.update_platform_username)
+promote_to_admin = _async(database.promote_to_admin)
+set_order_notification_status = _async(database.set_order_notification_status)
+get_order_notification_status = _cached(database.get_order_notification_status)
+set_appeal_notification_status = _async(database.set_appeal_notification_status)
+get_appeal_notification_status = _cached(database.get_appeal_notification_status)
+get_notification_status = _cached(database.get_notification_status)
+is_user_banned = _cached(database.is_user_banned)
+delete_user = _async(database.delete_user)
+get_platform_username = _cached(database.get_platform_username)
+get_user_stats = _cached(database.get_user_stats)
+get_active_user_sessions = _async(database.get_active_user_sessions)
+get_user_ids_by_platform_username = _cached(database.get_user_ids_by_platform_username)
+get_notification_recipients = _cached(database.get_notification_recipients)
+get_notification_recipients_bulk = _cached(database.get_notification_recipients_bulk)
+get_recipient = _cached(database.get_recipient)
+get_user_id_by_platform_username = _cached(database.get_user_id_by_platform_username)
+is_user_authorized = _cached(database.is_user_authorized)
+enqueue_outbox = _async(database.enqueue_outbox)
+claim_outbox_batch = _async(database.claim_outbox_batch)
+finish_outbox_batch = _async(database.finish_outbox_batch)
+release_outbox_claims = _async(database.release_outbox_claims)
+purge_outbox = _async(database.purge_outbox)
+save_processed_events = _async(database.save_processed_events)
+load_processed_events = _async(database.load_processed_events)
+purge_processed_events = _async(database.purge_processed_events)
+save_sent_alert = _async(database.save_sent_alert)
+get_sent_alerts = _async(database.get_sent_alerts)
+get_sent_alert = _async(database.get_sent_alert)
+purge_sent_alerts = _async(database.purge_sent_alerts)
+save_order_details = _async(database.save_order_details)
+update_order_details_status = _async(database.update_order_details_status)
+get_order_details = _async(database.get_order_details)
+purge_order_details = _async(database.purge_order_details)
@@ -0,0 +1,90 @@
+﻿import logging
+import time
+from collections import OrderedDict
+
+from config import DEDUP_TTL_SECONDS, DEDUP_MAX_ENTRIES
+from db_async import save_processed_events, load_processed_events
+
+logger = logging.getLogger(__name__)
+
+
+def event_key(event) -> tuple:
+    """Dedup key of the whole event (all recipients of the platform username)."""
+    return (event.order_id, event.status, f"user:{event.username}")
+
+
+def recipient_key(event, chat_id: int) -> tuple:
+    """Dedup key of the event for a single Telegram chat."""
+    return (event.order_id, event.status, str(chat_id))
+
+
+class DedupCache:
+    """Bounded LRU/TTL set of delivered event keys backed by SQLite.
+
+    Lookups only touch memory; the table is read once at startup so the
+    cache survives restarts, and written when new keys are added. Keys of
+    a delivery still in progress are reserved in memory only, so a retry
+    arriving meanwhile is skipped, and released again if the send fails.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> expires_at
+        self._reserved = set()
+
+    async def load(self):
+        rows = await load_processed_events(self.max_entries)
+        for order_id, status, recipient, expires_at in rows:
+            self._entries[(order_id, status, recipient)] = expires_at
+        logger.info(f"Loaded {len(self._entries)} processed event keys")
+
+    def seen(self, key) -> bool:
+        expires_at = self._entries.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            del self._entries[key]
+            return False
+        self._entries.move_to_end(key)
+        return True
+
+    def in_flight(self, key) -> bool:
+        """True if the key is reserved by a delivery that has not finished."""
+        return key in self._reserved
+
+    def reserve(self, keys):
+        """Mark keys as seen before sending, without persisting them."""
+        self._put(keys)
+        self._reserved.update(keys)
+
+    def release(self, keys):
+        """Forget reserved keys whose delivery failed."""
+        for key in keys:
+            if key in self._reserved:
+                self._reserved.discard(key)
+                self._entries.pop(key, None)
+
+    def _put(self, keys):
+        expires_at = time.time() + self.ttl
+        for key in keys:
+            self._entries[key] = expires_at
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._reserved.discard(key)
+        return expires_at
+
+    async def add(self, keys):
+        """Record delivered keys in memory and in the processed_events table."""
+        if not keys:
+            return
+        expires_at = self._put(keys)
+        self._reserved.difference_update(keys)
+        try:
+            await save_processed_events(keys, expires_at)
+        except Exception as e:
+            logger.error(f"Failed to persist processed event keys: {e}")
+
+
+dedup_cache = DedupCache(DEDUP_TTL_SECONDS, DEDUP_MAX_ENTRIES)
@@ -0,0 +1,76 @@
+﻿import asyncio
+import logging
+
+from config import TG_MAX_RETRIES
+from send_scheduler import retry_delay, retry_inline
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryQueue:
+    """In-process queue drained by a pool of async delivery workers.
+
+    Each worker owns its own queue and jobs are routed by ``chat_id``, so
+    messages for one chat are delivered in order while different chats are
+    served in parallel. A job failing with RetryAfter or a network error is
+    put back after its delay (behind the chat's newer jobs) rather than
+    awaited, so the worker moves on to the other chats meanwhile.
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self._queues = [asyncio.Queue(maxsize=maxsize) for _ in range(self.workers)]
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._worker(index)) for index in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} delivery workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id: int, job):
+        """Enqueue ``job`` (a coroutine function) for ``chat_id``.
+
+        Raises ``asyncio.QueueFull`` when the worker for this chat is saturated.
+        """
+        self._queues[hash(chat_id) % self.workers].put_nowait((chat_id, job, 1))
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def _retry(self, chat_id: int, job, attempt: int):
+        try:
+            self._queues[hash(chat_id) % self.workers].put_nowait((chat_id, job, attempt))
+        except asyncio.QueueFull:
+            logger.error(f"Delivery queue is full, dropping retry for {chat_id}")
+
+    async def _worker(self, index: int):
+        retry_inline.set(False)
+        queue = self._queues[index]
+        while True:
+            chat_id, job, attempt = await queue.get()
+            try:
+                await job()
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is not None and attempt <= TG_MAX_RETRIES:
+                    logger.warning(
+                        f"Delivery to {chat_id} failed: {e}, retry {attempt}/{TG_MAX_RETRIES} "
+                        f"in {delay:.1f}s"
+                    )
+                    asyncio.get_running_loop().call_later(
+                        delay, self._retry, chat_id, job, attempt + 1
+                    )
+                else:
+                    logger.error(f"Delivery to {chat_id} failed: {e}")
+            finally:
+                queue.task_done()
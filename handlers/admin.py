@@ -1,4 +1,5 @@
-﻿import logging
+﻿import asyncio
+import logging
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.helpers import escape_markdown
@@ -9,13 +10,15 @@ from config import (
     ADMIN_INFO_EDIT_BTN, ADMIN_BROADCAST_CONFIRM, ADMIN_USERNAMES,
     CONFIRM_BTN, CANCEL_BTN,
 )
-from database import (
-    is_admin, get_all_users, get_user_by_id, ban_user_by_id, unban_user_by_id,
-    get_user_stats, add_user, promote_to_admin, get_platform_username, is_user_banned
+from db_async import (
+    get_all_users, get_user_record, ban_user_by_id, unban_user_by_id,
+    get_user_stats, add_user, promote_to_admin,
 )
 from utils import load_info_text, save_info_text
+from send_scheduler import scheduler, PRIORITY_BROADCAST, PRIORITY_SERVICE
+from metrics import delivery_stats
 from config import DEFAULT_INFO, INFO_VIEW
-from handlers.session import user_states
+from handlers.session import user_states, user_snapshot, invalidate_user_snapshot
 from handlers.user import (
     ensure_active_session,
     show_info,
@@ -39,9 +42,10 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return ConversationHandler.END
 
-    if not get_user_by_id(user_id):
-        add_user(user_id, tg_username, "")
-        promote_to_admin(user_id)
+    if not await user_snapshot(update, context):
+        await add_user(user_id, tg_username, "")
+        await promote_to_admin(user_id)
+        invalidate_user_snapshot(context)
 
     user_states[user_id] = ADMIN_MENU
     return await show_admin_menu(update, context)
@@ -52,7 +56,7 @@ async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
     # Check if user is admin
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
     
@@ -90,7 +94,7 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Check if user is admin
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
     
@@ -115,7 +119,7 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Admin {user_id} pressed Back button in admin menu")
         
         # If admin is not authorized yet, restart the login flow
-        if not get_platform_username(user_id):
+        if not (await user_snapshot(update, context)).platform_username:
             user_states.pop(user_id, None)
             from handlers.user import start  # Imported here to avoid circular deps
             return await start(update, context)
@@ -136,7 +140,7 @@ async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
     # Check if user is admin
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
     
@@ -172,7 +176,7 @@ async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
     # Check if user is admin
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
     
@@ -215,7 +219,7 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
 
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return ConversationHandler.END
 
@@ -232,24 +236,32 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     message_text = context.user_data.get('broadcast_text', '')
 
-    users = get_all_users()
+    users = await get_all_users()
     success_count = 0
     fail_count = 0
 
-    for user in users:
-        user_telegram_id = user[0]
-        if user[3]:
-            continue
-        try:
-            await context.bot.send_message(
-                chat_id=user_telegram_id,
+    # The scheduler paces the broadcast behind order and appeal alerts
+    recipients = [user[0] for user in users if not user[3]]
+    results = await asyncio.gather(
+        *(
+            scheduler.send_message(
+                context.bot,
+                user_telegram_id,
+                PRIORITY_BROADCAST,
                 text=f"📢 *Сообщение от администратора*\n\n{message_text}",
                 parse_mode='Markdown'
             )
-            success_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to user {user_telegram_id}: {e}")
+            for user_telegram_id in recipients
+        ),
+        return_exceptions=True,
+    )
+
+    for user_telegram_id, result in zip(recipients, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send broadcast to user {user_telegram_id}: {result}")
             fail_count += 1
+        else:
+            success_count += 1
 
     await update.message.reply_text(
         f"✅ *Рассылка завершена*\n\n"
@@ -270,7 +282,7 @@ async def show_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message or (update.callback_query and update.callback_query.message)
 
     # Проверка прав администратора
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
 
@@ -278,7 +290,7 @@ async def show_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_states[user_id] = ADMIN_USER_LIST
     logger.info(f"Admin {user_id} is now in ADMIN_USER_LIST state")
 
-    users = get_all_users()
+    users = await get_all_users()
 
     reply_markup = ReplyKeyboardMarkup(
         [[BACK_BTN]],
@@ -344,7 +356,7 @@ async def handle_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
     # Check if user is admin
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
     
@@ -378,7 +390,7 @@ async def handle_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
     # Check if user is admin
-    if not is_admin(admin_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await query.edit_message_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
     
@@ -390,38 +402,39 @@ async def handle_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = int(callback_data[len(BAN_USER_PREFIX):])
     
     # Get user from database
-    user = get_user_by_id(user_id)
+    user = await get_user_record(user_id)
     if not user:
         await query.edit_message_text("⚠️ Пользователь не найден.")
         return
     
-    # Check if user is banned
-    is_banned = is_user_banned(user_id)
-    
-    if is_banned:
+    if user.is_banned:
         # Unban user
-        unban_user_by_id(user_id)
+        await unban_user_by_id(user_id)
         
-        await query.edit_message_text(f"✅ Пользователь {user[2]} разблокирован.")
+        await query.edit_message_text(f"✅ Пользователь {user.tg_username} разблокирован.")
         try:
-            await context.bot.send_message(
-                chat_id=user_id,
+            await scheduler.send_message(
+                context.bot,
+                user_id,
+                PRIORITY_SERVICE,
                 text="🔓 Ваш аккаунт был разблокирован. \n\nИспользуйте /start для повторной авторизации."
             )
         except Exception as e:
             logger.error(f"Failed to notify user {user_id} about unban: {e}")
     else:
         # Ban user
-        ban_user_by_id(user_id)
+        await ban_user_by_id(user_id)
 
         user_states.pop(user_id, None)
         user_data_temp.pop(user_id, None)
         password_attempts.pop(user_id, None)
         
-        await query.edit_message_text(f"🚫 Пользователь {user[2]} заблокирован.")
+        await query.edit_message_text(f"🚫 Пользователь {user.tg_username} заблокирован.")
         try:
-            await context.bot.send_message(
-                chat_id=user_id,
+            await scheduler.send_message(
+                context.bot,
+                user_id,
+                PRIORITY_SERVICE,
                 text=(
                     "🚫 Ваш аккаунт был заблокирован.\n\n"
                     f"По вопросам доступа к Боту можете обращаться к {SUPPORT_CONTACT}"
@@ -439,12 +452,13 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
     # Check if user is admin
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return await show_main_menu(update, context)
     
     # Get statistics from database
-    stats = get_user_stats()
+    stats = await get_user_stats()
+    delivery = delivery_stats()
     
     await update.message.reply_text(
         "📊 *Статистика*\n\n"
@@ -453,7 +467,14 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Заблокированных пользователей: {stats['banned']}\n"
         f"Администраторов: {stats['admin']}\n"
         f"Пользователей с ордерными оповещениями: {stats['order_notifications_enabled']}\n"
-        f"Пользователей с апелляционными оповещениями: {stats['appeal_notifications_enabled']}",
+        f"Пользователей с апелляционными оповещениями: {stats['appeal_notifications_enabled']}\n\n"
+        "📨 *Оповещения с момента запуска*\n\n"
+        f"Событий от платформы: {delivery['events']}\n"
+        f"Доставлено ордеров: {delivery['orders_delivered']}\n"
+        f"Доставлено апелляций: {delivery['appeals_delivered']}\n"
+        f"Среднее время доставки: {delivery['avg_delivery_seconds']:.2f} с\n"
+        f"Повторов отброшено: {delivery['duplicates']}\n"
+        f"Ошибок доставки: {delivery['errors']}",
        parse_mode='Markdown'
     )
     
@@ -495,7 +516,7 @@ async def receive_info_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_text = update.message.text
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return ConversationHandler.END
 
@@ -522,7 +543,7 @@ async def confirm_info_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     if not await ensure_active_session(update, context):
         return ConversationHandler.END
-    if not is_admin(user_id):
+    if not (await user_snapshot(update, context)).is_admin:
         await update.message.reply_text("⛔ У вас нет прав администратора для выполнения этой команды.")
         return ConversationHandler.END
 
@@ -1,2 +1,33 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from db_async import get_user_record
+from user_cache import UserRecord
 
 user_states = {}
+
+# The sender's users row for the update being handled, loaded once by
+# load_user_snapshot() before any other handler runs
+SNAPSHOT_KEY = "user_snapshot"
+
+
+async def load_user_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Group -1 handler: read the sender's row once for the whole update."""
+    if update.effective_user is None:
+        return
+    context.user_data[SNAPSHOT_KEY] = await get_user_record(update.effective_user.id)
+
+
+async def user_snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> UserRecord | None:
+    """The sender's row for this update, None if they are not registered.
+
+    Read again only if the snapshot was invalidated by a change to the user.
+    """
+    if SNAPSHOT_KEY not in context.user_data:
+        await load_user_snapshot(update, context)
+    return context.user_data.get(SNAPSHOT_KEY)
+
+
+def invalidate_user_snapshot(context: ContextTypes.DEFAULT_TYPE):
+    """Call after changing the sender's row so the next read sees the change."""
+    context.user_data.pop(SNAPSHOT_KEY, None)
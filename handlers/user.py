@@ -1,10 +1,11 @@
 ﻿import logging
 import html
+import time
 import requests
 import re
-from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.helpers import escape_markdown
 from config import (
@@ -14,15 +15,22 @@ from config import (
     ACTIVATE_APPEAL_BTN, DEACTIVATE_APPEAL_BTN,
     LOGOUT_BTN, BACK_BTN, ADMIN_BTN,
     CANCEL_LOGOUT, WAITING_INFO_TEXT, DEFAULT_INFO,
-    ADMIN_USERNAMES,
+    ADMIN_USERNAMES, ORDER_DETAILS_PREFIX,
 )
-from database import (
-    add_user, get_user_by_id,
-    get_order_notification_status, set_order_notification_status,
-    get_appeal_notification_status, set_appeal_notification_status,
-    is_admin, is_user_banned, delete_user, get_platform_username, promote_to_admin
+from db_async import (
+    add_user, set_order_notification_status, set_appeal_notification_status,
+    delete_user, promote_to_admin,
+    get_recipient, Recipient, get_sent_alert, save_sent_alert, SentAlert,
 )
-from utils import load_info_text, save_info_text, format_pay_type
+from utils import load_info_text, save_info_text
+from alerts import render_alert, render_update, render_details, RenderedAlert
+from payloads import AlertEvent, OrderUpdateEvent
+from metrics import ALERT_LATENCY
+from send_scheduler import scheduler, PRIORITY_SERVICE
+from coalesce import coalescer, alert_priority
+from order_cache import order_cache
+from handlers.session import user_snapshot, invalidate_user_snapshot
+from user_cache import username_key
 # from states import INFO_VIEW, user_states
 logger = logging.getLogger(__name__)
 
@@ -35,7 +43,7 @@ user_states = {}  # Track user states
 async def ensure_active_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Return True if the user exists, is not banned and has an active session."""
     user_id = update.effective_user.id
-    user = get_user_by_id(user_id)
+    user = await user_snapshot(update, context)
 
     if not user or user_id not in user_states:
         text = (
@@ -54,7 +62,7 @@ async def ensure_active_session(update: Update, context: ContextTypes.DEFAULT_TY
         password_attempts.pop(user_id, None)
         return False
 
-    if is_user_banned(user_id):
+    if user.is_banned:
         safe_support = escape_markdown(SUPPORT_CONTACT)
         text = (
             "❌ *Ваш аккаунт был заблокирован*\n\n"
@@ -88,7 +96,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"User {user_id} started the bot")
 
     # Проверка блокировки
-    if is_user_banned(user_id):
+    existing = await user_snapshot(update, context)
+    if existing and existing.is_banned:
         safe_support = escape_markdown(SUPPORT_CONTACT)
         await update.message.reply_text(
             "❌ *Ваш аккаунт был заблокирован*\n\n"
@@ -105,12 +114,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Если пользователь из списка ADMIN_USERNAMES, админ-панель доступна без авторизации
     if user.username in ADMIN_USERNAMES:
-        existing = get_user_by_id(user_id)
         if not existing:
-            add_user(user_id, user.username, "")
-            promote_to_admin(user_id)
+            await add_user(user_id, user.username, "")
+            await promote_to_admin(user_id)
         else:
-            promote_to_admin(user_id)
+            await promote_to_admin(user_id)
+        invalidate_user_snapshot(context)
     # Установка нового состояния
     user_states[user_id] = USERNAME
 
@@ -187,11 +196,12 @@ async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Получаем username из ответа сервера
             actual_username = data.get("username", entered_username)
 
-            add_user(user_id, tg_username, actual_username)
+            await add_user(user_id, tg_username, actual_username)
 
             # tg_username из ADMIN_USERNAMES получает роль администратора
             if tg_username in ADMIN_USERNAMES:
-                promote_to_admin(user_id)
+                await promote_to_admin(user_id)
+            invalidate_user_snapshot(context)
 
             return await show_main_menu(update, context, suppress_text=True)
 
@@ -224,8 +234,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, sup
         return ConversationHandler.END
 
     user_id = update.effective_user.id
-    platform_username = get_platform_username(user_id)
-    if not platform_username and not is_admin(user_id):
+    user = await user_snapshot(update, context)
+    if not user.platform_username and not user.is_admin:
         await context.bot.send_message(
             chat_id=user_id,
             text="⚠️ Сначала пройдите авторизацию командой /start",
@@ -233,8 +243,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, sup
         )
         return ConversationHandler.END
 
-    order_active = get_order_notification_status(user_id)
-    appeal_active = get_appeal_notification_status(user_id)
+    order_active = bool(user.notifications_enabled)
+    appeal_active = bool(user.appeal_notifications_enabled)
 
     user_states[user_id] = MAIN_MENU
     logger.info(f"User {user_id} is now in MAIN_MENU state")
@@ -246,7 +256,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, sup
         
     ]
 
-    if is_admin(user_id):
+    if user.is_admin:
         keyboard.append([ADMIN_BTN])
 
     reply_markup = ReplyKeyboardMarkup(
@@ -325,8 +335,10 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
     
+    user = await user_snapshot(update, context)
+
     # Check if user is banned
-    if is_user_banned(user_id):
+    if user and user.is_banned:
         safe_support = escape_markdown(SUPPORT_CONTACT)
         await update.message.reply_text(
             "🚫 Ваш аккаунт был заблокирован\n\n"
@@ -337,7 +349,6 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     # Check if user exists in database
-    user = get_user_by_id(user_id)
     if not user:
         await update.message.reply_text(
             "⚠️ *Сессия истекла*\n\n"
@@ -368,7 +379,7 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await activate_appeal_notifications(update, context)
     elif text == DEACTIVATE_APPEAL_BTN:
         return await deactivate_appeal_notifications(update, context)
-    elif text == ADMIN_BTN and is_admin(user_id):
+    elif text == ADMIN_BTN and user.is_admin:
         from handlers.admin import show_admin_menu
         return await show_admin_menu(update, context)
     else:
@@ -380,7 +391,8 @@ async def activate_order_notifications(update: Update, context: ContextTypes.DEF
         return ConversationHandler.END
 
     user_id = update.effective_user.id
-    set_order_notification_status(user_id, True)
+    await set_order_notification_status(user_id, True)
+    invalidate_user_snapshot(context)
     
     logger.info(f"User {user_id} activated notifications")
 
@@ -396,7 +408,8 @@ async def deactivate_order_notifications(update: Update, context: ContextTypes.D
         return ConversationHandler.END
 
     user_id = update.effective_user.id
-    set_order_notification_status(user_id, False)
+    await set_order_notification_status(user_id, False)
+    invalidate_user_snapshot(context)
     
     logger.info(f"User {user_id} deactivated notifications")
     # Возврат в меню с уведомлением
@@ -408,7 +421,8 @@ async def activate_appeal_notifications(update: Update, context: ContextTypes.DE
         return ConversationHandler.END
 
     user_id = update.effective_user.id
-    set_appeal_notification_status(user_id, True)
+    await set_appeal_notification_status(user_id, True)
+    invalidate_user_snapshot(context)
 
     logger.info(f"User {user_id} activated appeal notifications")
 
@@ -421,7 +435,8 @@ async def deactivate_appeal_notifications(update: Update, context: ContextTypes.
         return ConversationHandler.END
 
     user_id = update.effective_user.id
-    set_appeal_notification_status(user_id, False)
+    await set_appeal_notification_status(user_id, False)
+    invalidate_user_snapshot(context)
 
     logger.info(f"User {user_id} deactivated appeal notifications")
 
@@ -435,12 +450,11 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = update.effective_user.id
 
-    # Get user data from database
-    user = get_user_by_id(user_id)
-    # Extract user data
-    platform_username = user[3]  # platform_username is at index 3
-    is_order_active = bool(user[4])  # order_notifications_enabled is at index 4
-    is_appeal_active = bool(user[7])  # appeal_notifications_enabled is at index 7
+    # Get user data from the update's snapshot
+    user = await user_snapshot(update, context)
+    platform_username = user.platform_username
+    is_order_active = bool(user.notifications_enabled)
+    is_appeal_active = bool(user.appeal_notifications_enabled)
     
     # Update user state
     user_states[user_id] = PROFILE_VIEW
@@ -506,8 +520,8 @@ async def logout_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
     user_id = update.effective_user.id
     
-    # Get platform username from database
-    platform_username = get_platform_username(user_id)
+    # Get platform username from the update's snapshot
+    platform_username = (await user_snapshot(update, context)).platform_username
     if not platform_username:
         await update.message.reply_text(
             "⚠️ *Сессия истекла*\n\n"
@@ -564,7 +578,8 @@ async def handle_logout_confirmation(update: Update, context: ContextTypes.DEFAU
     # Check if username matches
     if entered_username == correct_username:
         # Username matches, proceed with logout
-        delete_user(user_id)
+        await delete_user(user_id)
+        invalidate_user_snapshot(context)
         
         # Clear user state
         if user_id in user_states:
@@ -603,8 +618,8 @@ async def cancel_logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.effective_user.id
     
-    # Get platform username from database
-    platform_username = get_platform_username(user_id)
+    # Get platform username from the update's snapshot
+    platform_username = (await user_snapshot(update, context)).platform_username
     if not platform_username:
         await context.bot.send_message(
             chat_id=user_id,
@@ -615,9 +630,10 @@ async def cancel_logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     
-    # Get notification status from database
-    is_order_active = get_order_notification_status(user_id)
-    is_appeal_active = get_appeal_notification_status(user_id)
+    # Get notification status from the update's snapshot
+    user = await user_snapshot(update, context)
+    is_order_active = bool(user.notifications_enabled)
+    is_appeal_active = bool(user.appeal_notifications_enabled)
     
     
     logger.info(f"User {user_id} canceled logout")
@@ -630,7 +646,7 @@ async def cancel_logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [DEACTIVATE_ORDER_BTN if is_order_active else ACTIVATE_ORDER_BTN,
          DEACTIVATE_APPEAL_BTN if is_appeal_active else ACTIVATE_APPEAL_BTN]
     ]
-    if is_admin(user_id):
+    if user.is_admin:
         keyboard.append([ADMIN_BTN])
     reply_markup = ReplyKeyboardMarkup(
         keyboard,
@@ -680,8 +696,9 @@ async def show_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     safe_info = html.escape(info_text)
     safe_support = html.escape(SUPPORT_CONTACT)
 
-    order_active = get_order_notification_status(user_id)
-    appeal_active = get_appeal_notification_status(user_id)
+    user = await user_snapshot(update, context)
+    order_active = bool(user.notifications_enabled)
+    appeal_active = bool(user.appeal_notifications_enabled)
 
     keyboard = [
         [PROFILE_BTN, INFO_BTN],
@@ -689,7 +706,7 @@ async def show_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
          DEACTIVATE_APPEAL_BTN if appeal_active else ACTIVATE_APPEAL_BTN]
     ]
 
-    if is_admin(user_id):
+    if user.is_admin:
         keyboard.append([ADMIN_BTN])
 
     reply_markup = ReplyKeyboardMarkup(
@@ -714,14 +731,16 @@ async def notify_account_unfrozen(bot, user_id: int):
     logger.info(f"Account unlocked for user {user_id}")
     # Switch user to the initial USERNAME state
     user_states[user_id] = USERNAME
-    await bot.send_message(
-        chat_id=user_id,
+    await scheduler.send_message(
+        bot,
+        user_id,
+        PRIORITY_SERVICE,
         text=(
             "🔓 Ваш аккаунт был разблокирован. "
             "Используйте /start для повторной авторизации."
         )
     )
-    await bot.send_message(chat_id=user_id, text="👤 Введите логин Трейдера:")
+    await scheduler.send_message(bot, user_id, PRIORITY_SERVICE, text="👤 Введите логин Трейдера:")
     # 👇 This function is called externally (via webhook from the platform) when access is unblocked
 async def unlock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # This can be connected via webhook or scheduler
@@ -739,10 +758,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Операция отменена.")
     
     # Check if user exists in database
-    user = get_user_by_id(user_id)
+    user = await user_snapshot(update, context)
     if user:
         # Check if user is admin
-        if is_admin(user_id):
+        if user.is_admin:
             # Update user state
             user_states[user_id] = MAIN_MENU
             # Import here to avoid circular imports
@@ -762,133 +781,119 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # 👇 This function is called externally (via webhook from the platform) when access is unblocked
-async def send_platform_notification(bot, user_id, data: dict):
-    """Send order or appeal alerts to the user based on payload."""
+async def send_platform_notification(
+    bot,
+    user_id,
+    event: AlertEvent,
+    recipient: Recipient | None = None,
+    rendered: RenderedAlert | None = None,
+    coalesce: bool = False,
+):
+    """Send order or appeal alerts to the user for a platform event.
+
+    ``recipient`` is the snapshot already resolved by the caller; when it is
+    omitted the user's ban state and notification flags are loaded here.
+    ``rendered`` lets fan-out callers render the message once per event.
+    With ``coalesce`` the alert may be merged into the chat's next digest;
+    the call then returns once that digest is sent.
+    """
+    if recipient is None:
+        recipient = await get_recipient(user_id)
+
     # Skip sending messages to banned users
-    if is_user_banned(user_id):
-        logger.info(f"Notification not sent to banned user {user_id}")
+    if recipient is None or recipient.banned:
+        logger.info(f"Notification not sent to unknown or banned user {user_id}")
         return
 
-    status = data.get("status")
+    status = event.status
 
     if status == "order":
-        if not get_order_notification_status(user_id):
+        if not recipient.order_enabled:
             logger.info(f"Notification not sent to user {user_id} (order notifications disabled)")
             return
-        created_key = "order_date_created"
-        timer_key = "order_timer"
-        title = "💸 Новый ордер"
     elif status == "appeal":
-        if not get_appeal_notification_status(user_id):
+        if not recipient.appeal_enabled:
             logger.info(f"Notification not sent to user {user_id} (appeal notifications disabled)")
             return
-        created_key = "appeal_date_created"
-        timer_key = "appeal_timer"
-        title = "⚠️ Новая апелляция"
     else:
         logger.warning(f"Unknown notification status: {status}")
         return
 
-    dt_format = "%d.%m.%Y %H:%M:%S"
-    created_raw = data.get(created_key, "")
-    created_dt = None
-    closing_dt = None
+    if rendered is None:
+        rendered = render_alert(event)
 
+    held = coalescer.hold(bot, user_id, event, rendered) if coalesce else None
+    if held is not None:
+        logger.info(f"Notification for {status} {event.order_id} held for user {user_id} digest")
+        await held
+        return
+
+    message = await scheduler.send_message(
+        bot, user_id, alert_priority(status), **rendered.send_kwargs()
+    )
+    if event.received_at:
+        ALERT_LATENCY.observe(time.time() - event.received_at, status)
+    logger.info(f"Notification sent to user {user_id} for {status} {event.order_id}")
     try:
-        utc_offset = int(data.get("UTC", 0))
-        created_dt = datetime.strptime(created_raw, dt_format)
-        created_dt += timedelta(hours=utc_offset)
-        closing_dt = created_dt + timedelta(minutes=int(data.get(timer_key, 0)))
+        await save_sent_alert(event.order_id, user_id, message.message_id, status, rendered.text)
     except Exception as e:
-        logger.error(f"Date parse error: {e}")
-
-    def fmt(dt: datetime | None, part: str) -> str:
-        if not dt:
-            return "ошибка"
-        return dt.strftime("%H:%M:%S") if part == "time" else dt.strftime("%d.%m.%Y")
-
-    created_time_str = fmt(created_dt, "time")
-    created_date_str = fmt(created_dt, "date")
-    closing_time_str = fmt(closing_dt, "time")
-    closing_date_str = fmt(closing_dt, "date")
-
-    utc_offset = int(data.get("UTC", 0))
-    utc_display = f"+{utc_offset}" if utc_offset >= 0 else str(utc_offset)
-
-    pay_type = data.get("type", "").lower()
-    pay_display = format_pay_type(pay_type)
-
-    card_last = str(data.get("requisites_cardNumber", ""))[-4:]
-    iban_last = str(data.get("requisites_ibanAcc", ""))[-4:]
-    name = data.get("requisites_name", "")
-    holder_name = data.get("requisites_cardholderName", "")
-    holder_surname = data.get("requisites_cardholderSurname", "")
-    holder_initial = holder_surname[:1]
-
-    if pay_type == "iban":
-        req_str = (
-            f"{name} "
-            f"UA***{iban_last}, {holder_name} {holder_initial}."
-        )
-    else:
-        req_str = (
-            f"{name} *{card_last}, "
-            f"{holder_name} {holder_initial}."
-        )
+        # The alert is delivered, only later edits of it are lost
+        logger.error(f"Failed to index alert {event.order_id} for user {user_id}: {e}")
+
+
+async def update_order_alert(
+    bot,
+    user_id,
+    event: OrderUpdateEvent,
+    alert: SentAlert | None = None,
+):
+    """Edit the alert sent for the order to reflect its lifecycle update.
+
+    ``alert`` is the sent_alerts row already loaded by the caller; when it
+    is omitted it is looked up here.
+    """
+    if alert is None:
+        alert = await get_sent_alert(event.order_id, user_id)
+    if alert is None:
+        logger.info(f"No alert for order {event.order_id} in chat {user_id} to update")
+        return
+    if alert.status == event.status:
+        return
 
-    if status == "order":
-        msg = (
-            f"{title}\n\n"
-            f"🔹 Сумма, фиат: {data.get('fiat_amount')} {data.get('currency').upper()}\n"
-            f"🔹 Реквизиты: {req_str}\n"
-            f"🔹 Способ оплаты: {pay_display}\n\n"
-            f"▫️ ID ордера: {data.get('order_id')}\n"
-            f"▫️ Ордер создан {created_time_str} (UTC{utc_display}), {created_date_str}\n"
-            f"▫️ Ордер будет закрыт {closing_time_str} (UTC{utc_display}), {closing_date_str}\n\n"
-            f"🔹 Мой курс: {data.get('trader_rate')} ({data.get('trader_fee')}%)\n"
-            f"🔹 Курс биржи: {data.get('exchange_rate')}"
-        )
-    else:  # appeal
-        order_created_dt = None
-        try:
-            order_created_raw = data.get("order_date_created", "")
-            order_created_dt = datetime.strptime(order_created_raw, dt_format)
-            order_created_dt += timedelta(hours=utc_offset)
-        except Exception:
-            pass
-
-        order_created_time = fmt(order_created_dt, "time")
-        order_created_date = fmt(order_created_dt, "date")
-
-        msg = (
-            f"{title}\n\n"
-            f"🔸 Сумма, фиат: {data.get('fiat_amount')} {data.get('currency').upper()}\n"
-            f"🔸 Реквизиты: {req_str}\n"
-            f"🔸 Способ оплаты: {pay_display}\n\n"
-            f"▫️ ID ордера: {data.get('order_id')}\n"
-            f"▫️ Ордер создан {order_created_time} (UTC{utc_display}), {order_created_date}\n"
-            f"▫️ Апелляция создана {created_time_str} (UTC{utc_display}), {created_date_str}\n"
-            f"▫️ Апелляция будет закрыта {closing_time_str} (UTC{utc_display}), {closing_date_str}"
+    rendered = render_update(event.order_id, alert.text, event.status)
+    try:
+        await scheduler.run(
+            user_id,
+            PRIORITY_SERVICE,
+            bot.edit_message_text,
+            chat_id=user_id,
+            message_id=alert.message_id,
+            **rendered.send_kwargs(),
         )
-
-    await bot.send_message(chat_id=user_id, text=msg, parse_mode=ParseMode.HTML)
-    logger.info(f"Notification sent to user {user_id} for {status} {data.get('order_id')}")
+    except BadRequest as e:
+        # Already edited by an earlier attempt
+        if "not modified" not in str(e).lower():
+            raise
+    # Keep the original text so a later update does not stack footers
+    await save_sent_alert(event.order_id, user_id, alert.message_id, event.status, alert.text)
+    logger.info(f"Alert for order {event.order_id} in chat {user_id} marked {event.status}")
 
 # Handle order details button
 async def order_details_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    order_id = query.data[len(ORDER_DETAILS_PREFIX):]
+
+    user = await user_snapshot(update, context)
+    username = user.platform_username if user else None
+    cached = await order_cache.get(order_id, username) if username else None
+    # Only the trader the order was alerted to may see its details
+    if cached is None or username_key(cached[1].username) != username_key(username):
+        await query.answer(
+            "Детали ордера недоступны. Для получения полной информации перейдите в личный кабинет.",
+            show_alert=True,
+        )
+        return
+
     await query.answer()
-    
-    # Extract order ID from callback data
-    order_id = query.data.split('_')[1]
-    
-    # Here you would fetch order details from your API
-    # For now, we'll just show a placeholder message
-    
-    await query.edit_message_text(
-        f"📋 *Детали ордера*\n\n"
-        f"ID: `{order_id}`\n"
-        f"Статус: В обработке\n\n"
-        f"Для получения полной информации перейдите в личный кабинет.",
-        parse_mode='Markdown'
-    )
+    status, event = cached
+    await query.edit_message_text(render_details(event, status), parse_mode=ParseMode.HTML)
@@ -2,17 +2,19 @@
 import asyncio
 import nest_asyncio
 from uvicorn import Config, Server
+from telegram import Update
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    ConversationHandler, filters, CallbackQueryHandler
+    ConversationHandler, filters, CallbackQueryHandler, TypeHandler
 )
-from database import init_db, get_active_user_sessions, delete_user
+from database import init_db, load_user_cache
+from db_async import get_active_user_sessions, delete_user
 from config import (
-    BOT_TOKEN, USERNAME, PASSWORD, MAIN_MENU, PROFILE_VIEW,
+    USERNAME, PASSWORD, MAIN_MENU, PROFILE_VIEW,
     INFO_VIEW, LOGOUT_CONFIRM, ADMIN_MENU, ADMIN_BROADCAST,
     ADMIN_BROADCAST_CONFIRM, ADMIN_USER_LIST, WAITING_INFO_TEXT,
-    WAITING_INFO_CONFIRM, CANCEL_LOGOUT, BAN_USER_PREFIX,
-    AUTH_ENDPOINT
+    WAITING_INFO_CONFIRM, CANCEL_LOGOUT, BAN_USER_PREFIX, ORDER_DETAILS_PREFIX,
+    AUTH_ENDPOINT, VALIDATE_SESSIONS, TELEGRAM_UPDATES_MODE, TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_SECRET,
 )
 from handlers.user import (
     start, receive_username, receive_password, handle_main_menu,
@@ -25,7 +27,10 @@ from handlers.admin import (
     handle_ban_user, info_edit_command, receive_info_text, confirm_info_text,
     admin_panel_command
 )
+from handlers.session import load_user_snapshot
 from webhook_server import app as fastapi_app  # FastAPI сервер
+from send_scheduler import scheduler, PRIORITY_SERVICE
+from telegram_client import bot
 
 from handlers.user import user_states
 import requests
@@ -42,18 +47,23 @@ nest_asyncio.apply()
 async def validate_sessions_task(app):
     """Periodically confirm active sessions with the platform."""
     while True:
-        users = get_active_user_sessions()
+        users = await get_active_user_sessions()
         for telegram_id, tg_username, platform_username in users:
             payload = {"username": platform_username, "tg_username": tg_username}
             try:
-                response = requests.post(AUTH_ENDPOINT, json=payload, timeout=10)
+                # In a thread: a slow platform must not stall the event loop
+                response = await asyncio.to_thread(
+                    requests.post, AUTH_ENDPOINT, json=payload, timeout=10
+                )
                 data = response.json()
                 if response.status_code == 401 or not data.get("Success"):
-                    delete_user(telegram_id)
+                    await delete_user(telegram_id)
                     user_states.pop(telegram_id, None)
                     try:
-                        await app.bot.send_message(
-                            chat_id=telegram_id,
+                        await scheduler.send_message(
+                            app.bot,
+                            telegram_id,
+                            PRIORITY_SERVICE,
                             text=(
                                 "⚠️ *Сессия истекла*\n\n"
                                 "Пожалуйста, авторизуйтесь снова, используя команду /start"
@@ -68,14 +78,41 @@ async def validate_sessions_task(app):
                 logger.error(f"Error validating session for user {telegram_id}: {e}")
         await asyncio.sleep(86400)
 
+async def run_webhook(app):
+    """Receive updates through the FastAPI route instead of long polling."""
+    if not TELEGRAM_WEBHOOK_URL or not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError(
+            "TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET are required in webhook mode"
+        )
+
+    await app.initialize()
+    await app.start()
+    fastapi_app.state.telegram_application = app
+    await app.bot.set_webhook(
+        url=f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/telegram/{TELEGRAM_WEBHOOK_SECRET}",
+        secret_token=TELEGRAM_WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    logger.info("Telegram updates are received via webhook")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        fastapi_app.state.telegram_application = None
+        await app.stop()
+        await app.shutdown()
+
 async def run_all():
     # Инициализация базы данных
     init_db()
+    load_user_cache()
 
     # Инициализация Telegram-приложения
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Один HTTP-клиент на весь процесс: тот же бот используется FastAPI
+    app = ApplicationBuilder().bot(bot).build()
 
     # Хэндлеры
+    # Снимок пользователя читается один раз до всех остальных хэндлеров
+    app.add_handler(TypeHandler(Update, load_user_snapshot), group=-1)
 
 
     auth_conv_handler = ConversationHandler(
@@ -110,7 +147,7 @@ async def run_all():
     app.add_handler(CommandHandler("admin", admin_panel_command))
     # app.add_handler(CallbackQueryHandler(cancel_logout, pattern=f"^{CANCEL_LOGOUT}$"))
     app.add_handler(CallbackQueryHandler(handle_ban_user, pattern=f"^{BAN_USER_PREFIX}"))
-    app.add_handler(CallbackQueryHandler(order_details_callback, pattern=r"^order_"))
+    app.add_handler(CallbackQueryHandler(order_details_callback, pattern=f"^{ORDER_DETAILS_PREFIX}"))
 
      # Fallback handlers to detect expired sessions after bot restarts
     app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_unknown))
@@ -118,14 +155,18 @@ async def run_all():
     logger.info("Запускается Telegram-бот и FastAPI сервер на порту 8000...")
 
     # Telegram и FastAPI — параллельно
-    telegram_task = asyncio.create_task(app.run_polling())
-    validation_task = asyncio.create_task(validate_sessions_task(app))
+    if TELEGRAM_UPDATES_MODE == "webhook":
+        telegram_task = asyncio.create_task(run_webhook(app))
+    else:
+        telegram_task = asyncio.create_task(app.run_polling())
+    tasks = [telegram_task]
+    if VALIDATE_SESSIONS:
+        tasks.append(asyncio.create_task(validate_sessions_task(app)))
     fastapi_config = Config(app=fastapi_app, host="0.0.0.0", port=8000, log_level="info", loop="asyncio")
     fastapi_server = Server(fastapi_config)
 
     await asyncio.gather(
-        telegram_task,
-        validation_task,
+        *tasks,
         fastapi_server.serve()
     )
 
@@ -0,0 +1,179 @@
+﻿import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+# Seconds; covers sub-millisecond SQLite calls up to slow Telegram requests
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self) -> dict:
+        """Current value per label tuple."""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = super().render()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Gauge(Metric):
+    """Gauge whose value is read from a callback at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def render(self):
+        return super().render() + [f"{self.name} {self.callback()}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def totals(self) -> dict:
+        """``(count, sum)`` of the observations per label tuple."""
+        with self._lock:
+            return {labels: (sum(series[:-1]), series[-1]) for labels, series in self._values.items()}
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = super().render()
+        for labels, series in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+def render_latest() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+ALERT_LATENCY = Histogram(
+    "alert_delivery_seconds",
+    "Time from receiving a platform event to the Telegram send completing",
+    labels=("status",),
+)
+ALERT_EVENTS = Counter(
+    "alert_events_total", "Platform events by outcome", labels=("outcome",)
+)
+ALERT_RECIPIENTS = Histogram(
+    "alert_recipients", "Resolved recipients per platform event",
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+TELEGRAM_LATENCY = Histogram(
+    "telegram_api_seconds", "Telegram Bot API call latency", labels=("method", "outcome")
+)
+TELEGRAM_RETRIES = Counter(
+    "telegram_retries_total", "Telegram calls rescheduled after an error", labels=("error",)
+)
+DB_LATENCY = Histogram(
+    "db_query_seconds", "database.py call latency", labels=("function",)
+)
+
+
+def delivery_stats() -> dict:
+    """Alert delivery figures since startup for the admin stats view."""
+    delivered = {labels[0]: totals for labels, totals in ALERT_LATENCY.totals().items()}
+    count = sum(count for count, _ in delivered.values())
+    seconds = sum(total for _, total in delivered.values())
+    events = {labels[0]: value for labels, value in ALERT_EVENTS.values().items()}
+    return {
+        "events": int(sum(events.values())),
+        "duplicates": int(events.get("duplicate", 0)),
+        "errors": int(events.get("error", 0) + events.get("queue_full", 0)),
+        "orders_delivered": delivered.get("order", (0, 0))[0],
+        "appeals_delivered": delivered.get("appeal", (0, 0))[0],
+        "avg_delivery_seconds": seconds / count if count else 0.0,
+    }
+
+
+def observe_db(func):
+    """Record the latency of a database.py function in DB_LATENCY."""
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - start, name)
+
+    return wrapper
@@ -0,0 +1,138 @@
+﻿import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+import requests
+
+from config import (
+    ORDER_CACHE_SIZE, ORDER_DETAILS_ENDPOINT, ORDER_DETAILS_TIMEOUT, ORDER_DETAILS_MISS_TTL,
+)
+from db_async import save_order_details, update_order_details_status, get_order_details
+from payloads import AlertEvent, PayloadError, loads
+
+logger = logging.getLogger(__name__)
+
+# Fields of the /new_order payload shown by render_details. Only these are
+# persisted, with the card, the IBAN and the cardholder surname cut to what
+# the alert displays anyway.
+_STORED_FIELDS = (
+    "status", "username", "order_id", "fiat_amount", "currency", "type",
+    "requisites_name", "requisites_cardholderName", "UTC", "order_date_created",
+    "order_timer", "appeal_date_created", "appeal_timer", "trader_rate",
+    "trader_fee", "exchange_rate",
+)
+
+
+def stored_payload(event: AlertEvent) -> dict:
+    """The masked subset of the event payload written to order_details."""
+    data = {key: event.payload[key] for key in _STORED_FIELDS if key in event.payload}
+    data["requisites_cardNumber"] = event.card_number[-4:]
+    data["requisites_ibanAcc"] = event.iban_account[-4:]
+    data["requisites_cardholderSurname"] = event.cardholder_surname[:1]
+    return data
+
+
+class OrderCache:
+    """Recently alerted orders for the "Details" button.
+
+    Keeps ``(status, AlertEvent)`` per order_id in a bounded LRU; every
+    write also goes to the order_details table, which serves orders evicted
+    from memory or alerted before a restart. Orders found in neither are
+    looked up on the platform (when ORDER_DETAILS_ENDPOINT is set) and the
+    result is cached as well; a failed lookup is remembered for
+    ORDER_DETAILS_MISS_TTL seconds so repeated taps do not repeat it.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # order_id -> (status, AlertEvent)
+        self._misses = OrderedDict()  # (order_id, username) -> expires_at
+
+    def _remember(self, order_id: str, status: str, event: AlertEvent):
+        self._entries[order_id] = (status, event)
+        self._entries.move_to_end(order_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def put(self, event: AlertEvent):
+        """Store an alerted order or appeal; the table gets the masked payload only."""
+        self._remember(event.order_id, event.status, event)
+        try:
+            await save_order_details(
+                event.order_id, event.status,
+                json.dumps(stored_payload(event), ensure_ascii=False),
+            )
+        except Exception as e:
+            logger.error(f"Failed to persist order details {event.order_id}: {e}")
+
+    async def set_status(self, order_id: str, status: str):
+        """Record a lifecycle update of an already cached order."""
+        entry = self._entries.get(order_id)
+        if entry is not None:
+            self._remember(order_id, status, entry[1])
+        try:
+            await update_order_details_status(order_id, status)
+        except Exception as e:
+            logger.error(f"Failed to persist status of order {order_id}: {e}")
+
+    async def get(self, order_id: str, username: str):
+        """Return ``(status, AlertEvent)`` for the order or None."""
+        entry = self._entries.get(order_id)
+        if entry is not None:
+            self._entries.move_to_end(order_id)
+            return entry
+
+        row = await get_order_details(order_id)
+        if row is not None:
+            status, payload = row
+            try:
+                event = AlertEvent.from_dict(loads(payload), received_at=0.0)
+            except PayloadError as e:
+                logger.error(f"Stored details of order {order_id} are invalid: {e}")
+            else:
+                self._remember(order_id, status, event)
+                return status, event
+
+        if not ORDER_DETAILS_ENDPOINT or self._missed(order_id, username):
+            return None
+        event = await asyncio.to_thread(fetch_order_details, order_id, username)
+        if event is None:
+            self._miss(order_id, username)
+            return None
+        await self.put(event)
+        return event.status, event
+
+    def _missed(self, order_id: str, username: str) -> bool:
+        expires_at = self._misses.get((order_id, username))
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            del self._misses[(order_id, username)]
+            return False
+        return True
+
+    def _miss(self, order_id: str, username: str):
+        self._misses[(order_id, username)] = time.time() + ORDER_DETAILS_MISS_TTL
+        self._misses.move_to_end((order_id, username))
+        while len(self._misses) > self.max_entries:
+            self._misses.popitem(last=False)
+
+
+def fetch_order_details(order_id: str, username: str):
+    """Look the order up on the platform; the response has the /new_order shape."""
+    try:
+        response = requests.post(
+            ORDER_DETAILS_ENDPOINT,
+            json={"order_id": order_id, "username": username},
+            timeout=ORDER_DETAILS_TIMEOUT,
+        )
+        response.raise_for_status()
+        return AlertEvent.from_dict(response.json(), received_at=0.0)
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f"Order details lookup for {order_id} failed: {e}")
+        return None
+
+
+order_cache = OrderCache(ORDER_CACHE_SIZE)
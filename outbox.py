@@ -0,0 +1,135 @@
+﻿import asyncio
+import logging
+import time
+from itertools import groupby
+
+from config import (
+    OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX, OUTBOX_RETENTION_HOURS,
+    NOTIFY_CONCURRENCY,
+)
+from db_async import (
+    claim_outbox_batch, finish_outbox_batch, release_outbox_claims, purge_outbox,
+)
+from handlers.user import (
+    send_platform_notification, notify_account_unfrozen, update_order_alert,
+)
+from alerts import render_alert
+from send_scheduler import retry_delay, retry_inline
+from payloads import AlertEvent, OrderUpdateEvent, loads
+
+logger = logging.getLogger(__name__)
+
+# Outbox row kinds
+ALERT = "alert"
+UNFROZEN = "unfrozen"
+UPDATE = "update"
+
+PURGE_INTERVAL = 3600  # seconds
+
+
+def backoff_delay(attempts: int) -> float:
+    """Delay before the next attempt after ``attempts`` failed ones."""
+    return min(OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)), OUTBOX_BACKOFF_MAX)
+
+
+class OutboxDispatcher:
+    """Background task that delivers rows from the persistent outbox."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        """Signal that new rows were written so they are picked up at once."""
+        self._wakeup.set()
+
+    async def _run(self):
+        # Failed rows are rescheduled in the outbox, not awaited in the scheduler
+        retry_inline.set(False)
+        released = await release_outbox_claims()
+        if released:
+            logger.info(f"Released {released} outbox rows claimed before restart")
+        last_purge = 0.0
+        while True:
+            try:
+                if time.time() - last_purge > PURGE_INTERVAL:
+                    await purge_outbox(time.time() - OUTBOX_RETENTION_HOURS * 3600)
+                    last_purge = time.time()
+
+                batch = await claim_outbox_batch(OUTBOX_BATCH_SIZE)
+                if batch:
+                    await self._deliver_batch(batch)
+                    continue
+            except Exception as e:
+                logger.error(f"Outbox dispatcher error: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver_batch(self, batch):
+        delivered, retries, dead, deferred = [], [], [], []
+        # Rows of one event share the payload, render it only once per batch
+        rendered_by_payload = {}
+
+        async def deliver_chat(rows):
+            # Rows of one chat are sent in order, chats run concurrently
+            async with self._semaphore:
+                for position, row in enumerate(rows):
+                    row_id, chat_id, kind, payload, attempts, created_at = row
+                    try:
+                        await self._send(chat_id, kind, payload, created_at, rendered_by_payload)
+                        delivered.append(row_id)
+                    except Exception as e:
+                        attempts += 1
+                        logger.error(
+                            f"Outbox delivery {row_id} to {chat_id} failed "
+                            f"(attempt {attempts}): {e}"
+                        )
+                        if attempts >= OUTBOX_MAX_ATTEMPTS:
+                            dead.append((row_id, str(e)))
+                            continue
+                        # Wait at least as long as a RetryAfter asks
+                        delay = max(backoff_delay(attempts), retry_delay(e, attempts) or 0)
+                        next_attempt_at = time.time() + delay
+                        retries.append((row_id, next_attempt_at, str(e)))
+                        # Later rows of the chat wait too, keeping its order
+                        deferred.extend(
+                            (later[0], next_attempt_at) for later in rows[position + 1:]
+                        )
+                        return
+
+        by_chat = sorted(batch, key=lambda row: (row[1], row[0]))
+        await asyncio.gather(
+            *(deliver_chat(list(rows)) for _, rows in groupby(by_chat, key=lambda row: row[1]))
+        )
+        await finish_outbox_batch(delivered, retries, dead, deferred)
+
+    async def _send(self, chat_id, kind, payload, created_at, rendered_by_payload):
+        if kind == ALERT:
+            if payload not in rendered_by_payload:
+                event = AlertEvent.from_dict(loads(payload), received_at=created_at)
+                rendered_by_payload[payload] = (event, render_alert(event))
+            event, rendered = rendered_by_payload[payload]
+            await send_platform_notification(self.bot, chat_id, event, rendered=rendered)
+        elif kind == UNFROZEN:
+            await notify_account_unfrozen(self.bot, chat_id)
+        elif kind == UPDATE:
+            await update_order_alert(self.bot, chat_id, OrderUpdateEvent.from_dict(loads(payload)))
+        else:
+            raise ValueError(f"Unknown outbox kind: {kind}")
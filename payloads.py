@@ -0,0 +1,145 @@
+﻿import time
+from dataclasses import dataclass, field
+
+try:
+    import orjson
+
+    def loads(raw: bytes):
+        return orjson.loads(raw)
+except ImportError:  # orjson is optional, fall back to the stdlib decoder
+    import json
+
+    def loads(raw: bytes):
+        return json.loads(raw)
+
+
+ALERT_STATUSES = ("order", "appeal")
+# Order lifecycle updates accepted by /order_update
+UPDATE_STATUSES = ("paid", "completed", "cancelled", "expired")
+
+
+class PayloadError(ValueError):
+    """Raised when a webhook payload cannot be decoded or is invalid."""
+
+
+def decode(raw: bytes):
+    try:
+        return loads(raw)
+    except ValueError as e:
+        raise PayloadError(f"invalid JSON: {e}") from None
+
+
+def _text(data: dict, key: str, required: bool = False) -> str:
+    value = data.get(key)
+    if value is None or value == "":
+        if required:
+            raise PayloadError(f"'{key}' is required")
+        return ""
+    return str(value)
+
+
+def _int(data: dict, key: str, default: int = 0) -> int:
+    value = data.get(key)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise PayloadError(f"'{key}' must be an integer") from None
+
+
+@dataclass(frozen=True, slots=True)
+class AlertEvent:
+    """Order or appeal event sent by the platform to /new_order."""
+    status: str
+    username: str
+    order_id: str
+    fiat_amount: str
+    currency: str
+    pay_type: str
+    requisites_name: str
+    card_number: str
+    iban_account: str
+    cardholder_name: str
+    cardholder_surname: str
+    utc: int
+    order_date_created: str
+    order_timer: str
+    appeal_date_created: str
+    appeal_timer: str
+    trader_rate: str
+    trader_fee: str
+    exchange_rate: str
+    # Original payload, kept for persistence (outbox) only
+    payload: dict = field(compare=False, repr=False)
+    # Wall-clock time the webhook received the event, for latency metrics
+    received_at: float = field(default=0.0, compare=False, repr=False)
+
+    @classmethod
+    def from_dict(cls, data, received_at: float | None = None) -> "AlertEvent":
+        if not isinstance(data, dict):
+            raise PayloadError("payload must be a JSON object")
+        status = _text(data, "status", required=True)
+        if status not in ALERT_STATUSES:
+            raise PayloadError(f"unknown status '{status}'")
+        return cls(
+            status=status,
+            username=_text(data, "username", required=True),
+            order_id=_text(data, "order_id", required=True),
+            fiat_amount=_text(data, "fiat_amount"),
+            currency=_text(data, "currency", required=True).upper(),
+            pay_type=_text(data, "type"),
+            requisites_name=_text(data, "requisites_name"),
+            card_number=_text(data, "requisites_cardNumber"),
+            iban_account=_text(data, "requisites_ibanAcc"),
+            cardholder_name=_text(data, "requisites_cardholderName"),
+            cardholder_surname=_text(data, "requisites_cardholderSurname"),
+            utc=_int(data, "UTC"),
+            order_date_created=_text(data, "order_date_created"),
+            order_timer=_text(data, "order_timer"),
+            appeal_date_created=_text(data, "appeal_date_created"),
+            appeal_timer=_text(data, "appeal_timer"),
+            trader_rate=_text(data, "trader_rate"),
+            trader_fee=_text(data, "trader_fee"),
+            exchange_rate=_text(data, "exchange_rate"),
+            payload=data,
+            received_at=time.time() if received_at is None else received_at,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class AuthStatusEvent:
+    """Account freeze update sent by the platform to /auth_status."""
+    username: str
+    authentication_freeze: str  # normalized to lower case, e.g. "false"
+
+    @classmethod
+    def from_dict(cls, data) -> "AuthStatusEvent":
+        if not isinstance(data, dict):
+            raise PayloadError("payload must be a JSON object")
+        return cls(
+            username=_text(data, "username", required=True),
+            authentication_freeze=str(data.get("authentication_freeze")).lower(),
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class OrderUpdateEvent:
+    """Order lifecycle change sent by the platform to /order_update."""
+    order_id: str
+    status: str
+    # Original payload, kept for persistence (outbox) only
+    payload: dict = field(compare=False, repr=False)
+
+    @classmethod
+    def from_dict(cls, data) -> "OrderUpdateEvent":
+        if not isinstance(data, dict):
+            raise PayloadError("payload must be a JSON object")
+        status = _text(data, "status", required=True).lower()
+        if status not in UPDATE_STATUSES:
+            raise PayloadError(f"unknown status '{status}'")
+        return cls(
+            order_id=_text(data, "order_id", required=True),
+            status=status,
+            payload=data,
+        )
@@ -0,0 +1,205 @@
+﻿import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from metrics import Gauge, TELEGRAM_LATENCY, TELEGRAM_RETRIES
+from config import (
+    TG_GLOBAL_RATE, TG_PER_CHAT_RATE, TG_PER_CHAT_BURST,
+    TG_MAX_RETRIES, TG_RETRY_BACKOFF_BASE, TG_RETRY_BACKOFF_MAX,
+)
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, a lower value is sent first
+PRIORITY_ORDER = 0
+PRIORITY_APPEAL = 1
+PRIORITY_BROADCAST = 2
+PRIORITY_SERVICE = 3  # session expiry, ban/unban and unfreeze notices
+
+# Drop idle per-chat buckets once this many are tracked
+MAX_CHAT_BUCKETS = 10000
+
+# Cleared by the outbox dispatcher and the delivery workers: they retry
+# failed rows and jobs themselves, so a retryable error is raised to them
+# at once instead of holding their other chats for the backoff
+retry_inline = contextvars.ContextVar("retry_inline", default=True)
+
+
+def retry_delay(error: Exception, attempt: int) -> float | None:
+    """Return how long to wait before retrying, or None for permanent errors.
+
+    ``attempt`` is the number of the attempt that just failed, starting at 1.
+    """
+    if isinstance(error, RetryAfter):
+        delay = error.retry_after
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+        return float(delay)
+    # BadRequest is a NetworkError subclass but retrying it cannot help
+    if isinstance(error, (Forbidden, BadRequest)):
+        return None
+    if isinstance(error, NetworkError):  # includes TimedOut
+        return min(TG_RETRY_BACKOFF_BASE * (2 ** (attempt - 1)), TG_RETRY_BACKOFF_MAX)
+    return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendScheduler:
+    """Single gate for outgoing Telegram calls.
+
+    Enforces a global and a per-chat rate with token buckets and serves
+    queued calls by priority lane. A chat that is over its limit is parked
+    without holding back calls for other chats. Calls failing with
+    RetryAfter or a network error are rescheduled the same way unless the
+    caller cleared ``retry_inline``; other errors are raised to the caller
+    right away.
+    """
+
+    def __init__(self, global_rate: float, per_chat_rate: float, per_chat_burst: int):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats = {}  # chat_id -> TokenBucket
+        self._seq = itertools.count()
+        self._queue = None
+        self._task = None
+        self._inflight = set()
+        self.retries = Counter()  # error class -> retries scheduled
+        self.retry_delay_total = Counter()  # error class -> seconds waited
+        self.gave_up = Counter()  # error class -> calls failed for good
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.PriorityQueue()
+            self._task = asyncio.create_task(self._run())
+
+    async def run(self, chat_id: int, priority: int, func, /, *args, **kwargs):
+        """Schedule ``func(*args, **kwargs)`` for ``chat_id`` and await its result.
+
+        The leading parameters are positional-only so ``kwargs`` may carry
+        the Bot API's own ``chat_id``.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        retries = TG_MAX_RETRIES if retry_inline.get() else 0
+        self._queue.put_nowait(
+            (priority, next(self._seq), chat_id, func, args, kwargs, future, 1, retries)
+        )
+        return await future
+
+    async def send_message(self, bot, chat_id: int, priority: int = PRIORITY_SERVICE, /, **kwargs):
+        return await self.run(chat_id, priority, bot.send_message, chat_id=chat_id, **kwargs)
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def retry_stats(self) -> dict:
+        return {
+            "retries": dict(self.retries),
+            "retry_delay_seconds": dict(self.retry_delay_total),
+            "gave_up": dict(self.gave_up),
+        }
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {
+                    key: value for key, value in self._chats.items() if not value.is_full(now)
+                }
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            chat_id = item[2]
+            now = time.monotonic()
+
+            chat_bucket = self._chat_bucket(chat_id, now)
+            wait = chat_bucket.wait_time(now)
+            if wait > 0:
+                # Park the call until the chat has a token again
+                loop.call_later(wait, self._queue.put_nowait, item)
+                continue
+
+            wait = self._global.wait_time(now)
+            if wait > 0:
+                # Put it back so a higher priority call can overtake it
+                self._queue.put_nowait(item)
+                await asyncio.sleep(wait)
+                continue
+
+            chat_bucket.consume()
+            self._global.consume()
+            task = asyncio.create_task(self._execute(item))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _execute(self, item):
+        priority, seq, chat_id, func, args, kwargs, future, attempt, retries = item
+        if future.done():
+            return
+        method = getattr(func, "__name__", "call")
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            error_class = type(e).__name__
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method, error_class)
+            delay = retry_delay(e, attempt)
+            if delay is not None and attempt <= retries:
+                TELEGRAM_RETRIES.inc(error_class)
+                self.retries[error_class] += 1
+                self.retry_delay_total[error_class] += delay
+                logger.warning(
+                    f"{error_class} for chat {chat_id}, retry {attempt}/{retries} "
+                    f"in {delay:.1f}s"
+                )
+                retry = (priority, seq, chat_id, func, args, kwargs, future, attempt + 1, retries)
+                asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, retry)
+                return
+            self.gave_up[error_class] += 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - start, method, "ok")
+            if not future.done():
+                future.set_result(result)
+
+
+scheduler = SendScheduler(TG_GLOBAL_RATE, TG_PER_CHAT_RATE, TG_PER_CHAT_BURST)
+Gauge("send_scheduler_queue_depth", "Telegram calls waiting in the send scheduler", scheduler.depth)
@@ -0,0 +1,46 @@
+﻿import logging
+
+import httpx
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+from config import (
+    BOT_TOKEN, TG_CONNECTION_POOL_SIZE, TG_CONNECT_TIMEOUT, TG_READ_TIMEOUT,
+    TG_WRITE_TIMEOUT, TG_POOL_TIMEOUT, TG_KEEPALIVE_EXPIRY, TG_HTTP_VERSION,
+    TELEGRAM_BASE_URL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def build_request(pool_size: int = TG_CONNECTION_POOL_SIZE, **kwargs) -> HTTPXRequest:
+    """Create the HTTPX-backed request object used for Bot API calls."""
+    options = {
+        "connection_pool_size": pool_size,
+        "connect_timeout": TG_CONNECT_TIMEOUT,
+        "read_timeout": TG_READ_TIMEOUT,
+        "write_timeout": TG_WRITE_TIMEOUT,
+        "pool_timeout": TG_POOL_TIMEOUT,
+        "http_version": TG_HTTP_VERSION,
+    }
+    if TG_KEEPALIVE_EXPIRY:
+        options["httpx_kwargs"] = {
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=float(TG_KEEPALIVE_EXPIRY),
+            )
+        }
+    options.update(kwargs)
+    return HTTPXRequest(**options)
+
+
+# The one bot used by both the PTB application and the FastAPI routes.
+# get_updates holds its connection for the whole long poll, so it gets its
+# own single-connection pool instead of taking one from the send pool.
+bot = ExtBot(
+    token=BOT_TOKEN,
+    base_url=TELEGRAM_BASE_URL,
+    request=build_request(),
+    get_updates_request=build_request(pool_size=1),
+)
@@ -0,0 +1,48 @@
+import json
+import unittest
+
+from alerts import render_details
+from order_cache import stored_payload
+from payloads import AlertEvent
+
+PAYLOAD = {
+    "status": "order",
+    "username": "trader1",
+    "order_id": "A-1",
+    "fiat_amount": "1500",
+    "currency": "uah",
+    "type": "card",
+    "requisites_name": "Monobank",
+    "requisites_cardNumber": "4441111122223333",
+    "requisites_ibanAcc": "UA213223130000026007233566001",
+    "requisites_cardholderName": "Ivan",
+    "requisites_cardholderSurname": "Petrenko",
+    "UTC": 3,
+    "order_date_created": "2026-01-01 12:00:00",
+    "order_timer": "15",
+    "trader_rate": "41.5",
+    "trader_fee": "1",
+    "exchange_rate": "41.2",
+    "client_phone": "+380000000000",
+}
+
+
+class StoredPayloadTest(unittest.TestCase):
+    def setUp(self):
+        self.event = AlertEvent.from_dict(PAYLOAD)
+        self.stored = stored_payload(self.event)
+
+    def test_sensitive_fields_are_masked(self):
+        raw = json.dumps(self.stored, ensure_ascii=False)
+        self.assertNotIn("4441111122223333", raw)
+        self.assertNotIn("UA213223130000026007233566001", raw)
+        self.assertNotIn("Petrenko", raw)
+        self.assertNotIn("client_phone", self.stored)
+
+    def test_details_render_the_same_from_stored_payload(self):
+        restored = AlertEvent.from_dict(self.stored, received_at=0.0)
+        self.assertEqual(render_details(restored, "paid"), render_details(self.event, "paid"))
+
+
+if __name__ == "__main__":
+    unittest.main()
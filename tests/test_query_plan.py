@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import database
+
+INDEX = "idx_users_active_platform_username"
+
+
+class RecipientQueryPlanTest(unittest.TestCase):
+    """The webhook recipient lookups must be served by the partial username index."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="query_plan_")
+        database.close_connection()
+        patcher = mock.patch.object(database, "DB_NAME", os.path.join(self.tmpdir, "users.db"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.addCleanup(database.user_cache.clear)
+        self.addCleanup(database.close_connection)
+
+        database.init_db()
+        for index in range(100):
+            database.add_user(1_000 + index, f"tg_{index}", f"Trader_{index % 10}")
+        database.ban_user_by_id(1_000)
+        # With the cache off the lookups go to SQLite
+        database.user_cache.clear()
+
+    def _selects(self, lookup, *args):
+        conn = database.connect()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            lookup(*args)
+        finally:
+            conn.set_trace_callback(None)
+        return [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+
+    def assertUsesIndex(self, lookup, *args):
+        selects = self._selects(lookup, *args)
+        self.assertTrue(selects, f"{lookup.__name__} ran no SELECT")
+        conn = database.connect()
+        for sql in selects:
+            plan = " / ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"))
+            with self.subTest(sql=sql):
+                self.assertIn(f"INDEX {INDEX}", plan)
+                self.assertNotIn("SCAN", plan)
+                self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_user_ids_by_platform_username(self):
+        self.assertUsesIndex(database.get_user_ids_by_platform_username, "trader_1")
+
+    def test_notification_recipients(self):
+        self.assertUsesIndex(database.get_notification_recipients, "TRADER_2")
+
+    def test_notification_recipients_bulk(self):
+        self.assertUsesIndex(database.get_notification_recipients_bulk, ["Trader_3", "trader_4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
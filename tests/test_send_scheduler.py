@@ -0,0 +1,55 @@
+import unittest
+from types import SimpleNamespace
+
+from telegram.error import NetworkError
+
+from send_scheduler import SendScheduler, PRIORITY_ORDER, PRIORITY_SERVICE, retry_inline
+
+
+class FakeBot:
+    """Records Bot API calls and answers them like Telegram would."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(("send_message", chat_id, text))
+        return SimpleNamespace(message_id=len(self.calls), chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(("edit_message_text", chat_id, text))
+        return True
+
+
+class SendSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.bot = FakeBot()
+        self.scheduler = SendScheduler(global_rate=1000, per_chat_rate=1000, per_chat_burst=10)
+
+    async def test_send_message_reaches_bot(self):
+        message = await self.scheduler.send_message(self.bot, 5, PRIORITY_ORDER, text="x")
+        self.assertEqual(message.chat_id, 5)
+        self.assertEqual(self.bot.calls, [("send_message", 5, "x")])
+
+    async def test_run_passes_chat_id_keyword_through(self):
+        result = await self.scheduler.run(
+            5, PRIORITY_SERVICE, self.bot.edit_message_text,
+            chat_id=5, message_id=1, text="edited",
+        )
+        self.assertTrue(result)
+        self.assertEqual(self.bot.calls, [("edit_message_text", 5, "edited")])
+
+    async def test_retryable_error_raised_at_once_without_inline_retries(self):
+        async def failing_send(chat_id, text):
+            self.bot.calls.append(("send_message", chat_id, text))
+            raise NetworkError("connection reset")
+
+        self.bot.send_message = failing_send
+        retry_inline.set(False)
+        with self.assertRaises(NetworkError):
+            await self.scheduler.send_message(self.bot, 5, PRIORITY_ORDER, text="x")
+        self.assertEqual(len(self.bot.calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
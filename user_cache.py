@@ -0,0 +1,187 @@
+﻿import string
+import threading
+from collections import Counter
+
+# SQLite's built-in lower() only folds ASCII letters
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def username_key(platform_username):
+    """Case-normalized platform username, equal to SQLite's lower()."""
+    if platform_username is None:
+        return None
+    return platform_username.translate(_ASCII_LOWER)
+
+
+class UserRecord:
+    """One row of the users table, column values kept as stored."""
+    __slots__ = (
+        "id", "telegram_id", "tg_username", "platform_username",
+        "notifications_enabled", "appeal_notifications_enabled", "role", "banned",
+    )
+
+    def __init__(
+        self, id, telegram_id, tg_username, platform_username,
+        notifications_enabled, appeal_notifications_enabled, role, banned,
+    ):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.tg_username = tg_username
+        self.platform_username = platform_username
+        self.notifications_enabled = notifications_enabled
+        self.appeal_notifications_enabled = appeal_notifications_enabled
+        self.role = role
+        self.banned = banned
+
+    def as_row(self) -> tuple:
+        """The record as a tuple in ``__slots__`` column order.
+
+        Not necessarily ``SELECT *`` order: on databases created before the
+        baseline migration appeal_notifications_enabled is the last column.
+        """
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def replace(self, **changes) -> "UserRecord":
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return UserRecord(**values)
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role == "admin"
+
+    @property
+    def is_banned(self) -> bool:
+        return bool(self.banned)
+
+    def stat_keys(self):
+        """Keys of the get_user_stats() counters this record contributes to."""
+        yield "total"
+        if self.banned == 0:
+            yield "active"
+        elif self.banned == 1:
+            yield "banned"
+        if self.role == "admin":
+            yield "admin"
+        if self.notifications_enabled == 1:
+            yield "order_notifications_enabled"
+        if self.appeal_notifications_enabled == 1:
+            yield "appeal_notifications_enabled"
+
+
+class UserCache:
+    """Process-local copy of the users table.
+
+    Indexed by telegram_id and by case-normalized platform_username (a set
+    of telegram ids). Filled once by ``database.load_user_cache()`` and kept
+    coherent by the database.py mutators, which update it after their
+    commit. Records are never changed in place, so readers on other threads
+    always see a whole row. Writers hold ``write_lock`` across their commit
+    and the cache change, so both apply writes in the same order; the
+    indexes are only read or changed under the internal lock, which is never
+    held during a query, so readers on the event loop never wait on SQLite.
+    The get_user_stats() counters are adjusted on every change, so reading
+    them does not depend on the number of users. Until the cache is loaded
+    every read goes to SQLite.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._by_id = {}
+        self._by_platform = {}
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self.write_lock = threading.RLock()
+
+    def load(self, rows):
+        by_id = {}
+        by_platform = {}
+        counts = Counter()
+        for row in rows:
+            record = UserRecord(*row)
+            by_id[record.telegram_id] = record
+            counts.update(record.stat_keys())
+            by_platform.setdefault(username_key(record.platform_username), set()).add(
+                record.telegram_id
+            )
+        with self._lock:
+            self._by_id = by_id
+            self._by_platform = by_platform
+            self._counts = counts
+            self.loaded = True
+
+    def clear(self):
+        """Forget everything and send reads back to SQLite."""
+        with self._lock:
+            self.loaded = False
+            self._by_id = {}
+            self._by_platform = {}
+            self._counts = Counter()
+
+    def get(self, telegram_id):
+        with self._lock:
+            return self._by_id.get(telegram_id)
+
+    def by_platform_username(self, platform_username) -> list:
+        """Records of the platform username, any case, ordered by telegram_id."""
+        with self._lock:
+            ids = sorted(self._by_platform.get(username_key(platform_username), ()))
+            return [self._by_id[telegram_id] for telegram_id in ids if telegram_id in self._by_id]
+
+    def stats(self) -> dict:
+        """User counts in the shape returned by database.get_user_stats()."""
+        with self._lock:
+            counts = self._counts.copy()
+        return {
+            key: counts[key]
+            for key in (
+                "total", "active", "banned", "admin",
+                "order_notifications_enabled", "appeal_notifications_enabled",
+            )
+        }
+
+    def put(self, record: UserRecord):
+        with self._lock:
+            self._remove(record.telegram_id)
+            self._by_id[record.telegram_id] = record
+            self._index(record)
+            self._counts.update(record.stat_keys())
+
+    def update(self, telegram_id, **changes):
+        with self._lock:
+            record = self._by_id.get(telegram_id)
+            if record is None:
+                return
+            updated = record.replace(**changes)
+            if "platform_username" in changes:
+                self._unindex(record)
+                self._index(updated)
+            self._counts.subtract(record.stat_keys())
+            self._counts.update(updated.stat_keys())
+            self._by_id[telegram_id] = updated
+
+    def remove(self, telegram_id):
+        with self._lock:
+            self._remove(telegram_id)
+
+    def _remove(self, telegram_id):
+        record = self._by_id.pop(telegram_id, None)
+        if record is None:
+            return
+        self._unindex(record)
+        self._counts.subtract(record.stat_keys())
+
+    def _index(self, record: UserRecord):
+        key = username_key(record.platform_username)
+        self._by_platform.setdefault(key, set()).add(record.telegram_id)
+
+    def _unindex(self, record: UserRecord):
+        key = username_key(record.platform_username)
+        ids = self._by_platform.get(key)
+        if ids is not None:
+            ids.discard(record.telegram_id)
+            if not ids:
+                del self._by_platform[key]
+
+
+user_cache = UserCache()
@@ -1,87 +1,445 @@
-﻿from fastapi import FastAPI, Request
-from telegram import Bot
-from database import (
-    get_user_ids_by_platform_username,
-    get_order_notification_status,
-    get_appeal_notification_status,
-    is_user_authorized,
+﻿import asyncio
+import hmac
+import json
+import time
+from functools import partial
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from telegram import Update
+from db_async import (
+    get_user_ids_by_platform_username, get_notification_recipients,
+    get_notification_recipients_bulk, enqueue_outbox, get_sent_alerts, purge_sent_alerts,
+    purge_order_details, purge_processed_events,
+)
+from handlers.user import (
+    send_platform_notification, notify_account_unfrozen, update_order_alert,
 )
-from handlers.user import send_platform_notification, notify_account_unfrozen
 import os
 import logging
-from config import BOT_TOKEN as API_TOKEN
-
-bot = Bot(token=API_TOKEN)
+from delivery import DeliveryQueue
+from outbox import OutboxDispatcher, ALERT, UNFROZEN, UPDATE
+from dedup import dedup_cache, event_key, recipient_key
+from order_cache import order_cache
+from alerts import render_alert
+from user_cache import username_key
+from payloads import AlertEvent, AuthStatusEvent, OrderUpdateEvent, PayloadError, decode
+from telegram_client import bot
+from capture import capture
+from metrics import ALERT_EVENTS, ALERT_RECIPIENTS, Gauge, render_latest
+from config import (
+    NOTIFY_CONCURRENCY, WEBHOOK_DELIVERY_MODE, DELIVERY_WORKERS, DELIVERY_QUEUE_SIZE,
+    TELEGRAM_WEBHOOK_SECRET, SENT_ALERT_RETENTION_HOURS,
+)
 
 app = FastAPI()
 logger = logging.getLogger(__name__)
 
+# PTB Application receiving updates via /telegram/<secret>, set by main.py
+app.state.telegram_application = None
+
+delivery_queue = DeliveryQueue(DELIVERY_WORKERS, DELIVERY_QUEUE_SIZE)
+outbox_dispatcher = OutboxDispatcher(bot)
+Gauge("delivery_queue_depth", "Jobs waiting for the delivery workers", delivery_queue.depth)
+
+
+@app.on_event("startup")
+async def start_delivery_workers():
+    # Shared with the PTB application, initializing twice is a no-op
+    await bot.initialize()
+    await dedup_cache.load()
+    app.state.purge_task = asyncio.create_task(purge_sent_alerts_task())
+    if WEBHOOK_DELIVERY_MODE == "queue":
+        delivery_queue.start()
+    elif WEBHOOK_DELIVERY_MODE == "outbox":
+        outbox_dispatcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_delivery_workers():
+    await delivery_queue.stop()
+    await outbox_dispatcher.stop()
+    app.state.purge_task.cancel()
+    capture.close()
+    await bot.shutdown()
+
+
+async def purge_sent_alerts_task():
+    """Hourly drop rows that are no longer needed.
+
+    Sent alerts and order details too old to be edited or shown, and dedup
+    keys past their TTL.
+    """
+    while True:
+        try:
+            older_than = time.time() - SENT_ALERT_RETENTION_HOURS * 3600
+            purged = (
+                await purge_sent_alerts(older_than) + await purge_order_details(older_than)
+            )
+            if purged:
+                logger.info(f"Purged {purged} old sent alert rows")
+            expired = await purge_processed_events(time.time())
+            if expired:
+                logger.info(f"Purged {expired} expired processed event keys")
+        except Exception as e:
+            logger.error(f"Failed to purge sent alerts: {e}")
+        await asyncio.sleep(3600)
+
+
+def enqueue(jobs) -> dict:
+    """Queue ``(chat_id, job)`` pairs for the delivery workers."""
+    queued = 0
+    for chat_id, job in jobs:
+        try:
+            delivery_queue.submit(chat_id, job)
+        except asyncio.QueueFull:
+            logger.error(f"Delivery queue is full, dropping job for {chat_id}")
+            return {"status": "queue_full", "queued": queued}
+        queued += 1
+    return {"status": "queued", "queued": queued}
+
+
+async def store_in_outbox(chat_ids, kind: str, payload: dict | None = None) -> dict:
+    """Persist the event for every chat and wake the dispatcher."""
+    queued = await enqueue_outbox(chat_ids, kind, json.dumps(payload or {}, ensure_ascii=False))
+    outbox_dispatcher.wake()
+    return {"status": "queued", "queued": queued}
+
+
+def to_response(result: dict):
+    """Answer 202 for queued work and 503 when the queue is saturated.
+
+    409 while an earlier call for the same event is still sending, so the
+    platform retries it later.
+    """
+    if result["status"] == "queued":
+        return JSONResponse(status_code=202, content=result)
+    if result["status"] == "queue_full":
+        return JSONResponse(status_code=503, content=result)
+    if result["status"] == "in_progress":
+        return JSONResponse(status_code=409, content=result)
+    return result
+
+
+def counted(result: dict) -> dict:
+    """Count the outcome of one platform event for /metrics."""
+    ALERT_EVENTS.inc(result["status"])
+    return result
+
+
+def invalid_payload(error: PayloadError) -> JSONResponse:
+    logger.warning(f"Rejected webhook payload: {error}")
+    return JSONResponse(
+        status_code=422,
+        content={"status": "invalid_payload", "detail": str(error)},
+    )
+
+
+async def fan_out(
+    event: AlertEvent, recipients, rendered=None, coalesce: bool = True
+) -> tuple[list, str | None]:
+    """Deliver one event to all recipients concurrently.
+
+    At most ``NOTIFY_CONCURRENCY`` sends are in flight at once. Returns
+    the recipients that were sent to and the last error message, if any.
+    """
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def deliver(recipient):
+        async with semaphore:
+            await send_platform_notification(
+                bot, recipient.telegram_id, event,
+                recipient=recipient, rendered=rendered, coalesce=coalesce,
+            )
+
+    results = await asyncio.gather(
+        *(deliver(recipient) for recipient in recipients),
+        return_exceptions=True,
+    )
+
+    delivered = []
+    send_error = None
+    for recipient, result in zip(recipients, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send notification to {recipient.telegram_id}: {result}")
+            send_error = str(result)
+        else:
+            delivered.append(recipient)
+    return delivered, send_error
+
+
 @app.get("/")
 async def root():
     return {"status": "FastAPI запущен"}
 
-@app.post("/new_order")
-async def new_order(request: Request):
-    data = await request.json()
 
-    platform_username = data.get("username")  # username трейдера на платформе
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_latest(), media_type="text/plain; version=0.0.4")
+
 
-    users = get_user_ids_by_platform_username(platform_username)
+async def process_order_event(event: AlertEvent, recipients, coalesce: bool = True) -> dict:
+    """Deliver one validated order/appeal event to its resolved recipients.
 
-    if not users:
-        logger.warning(f"No user found for platform_username={platform_username}")
+    ``coalesce`` lets inline sends be merged into the chat's next digest.
+    """
+    ALERT_RECIPIENTS.observe(len(recipients))
+    if not recipients:
+        logger.warning(f"No user found for platform_username={event.username}")
         return {"status": "no_user"}
 
-    status = data.get("status")
+    status = event.status
 
-    sent_any = False
-    send_error = None
-    for user_id in users:
-        if not is_user_authorized(user_id):
-            logger.warning(f"User {user_id} is not authorized to receive notifications")
+    targets = []
+    for recipient in recipients:
+        if not recipient.wants(status):
+            logger.info(f"{status} notifications disabled for user {recipient.telegram_id}")
             continue
+        targets.append(recipient)
 
-        if status == "order" and not get_order_notification_status(user_id):
-            logger.info(f"Order notifications disabled for user {user_id}")
-            continue
+    if not targets:
+        return {"status": "notifications_off"}
 
-        if status == "appeal" and not get_appeal_notification_status(user_id):
-            logger.info(f"Appeal notifications disabled for user {user_id}")
-            continue
+    # An earlier call is still sending this event; it may yet fail, so the
+    # platform is asked to retry instead of being told it was delivered
+    if any(
+        dedup_cache.in_flight(recipient_key(event, recipient.telegram_id))
+        for recipient in targets
+    ):
+        return {"status": "in_progress"}
+
+    # Recipients that already got this event from an earlier (retried) call
+    pending = [
+        recipient for recipient in targets
+        if not dedup_cache.seen(recipient_key(event, recipient.telegram_id))
+    ]
+    if not pending:
+        await dedup_cache.add([event_key(event)])
+        return {"status": "duplicate"}
+
+    # Reserved before the first await so a retry arriving while this call
+    # is still sending sees them and does not alert the chats twice
+    reserved = [recipient_key(event, recipient.telegram_id) for recipient in pending]
+    dedup_cache.reserve(reserved)
+    try:
+        rendered = render_alert(event)
+        await order_cache.put(event)
+
+        if WEBHOOK_DELIVERY_MODE == "outbox":
+            result = await store_in_outbox(
+                [recipient.telegram_id for recipient in pending], ALERT, event.payload
+            )
+            accepted = pending
+        elif WEBHOOK_DELIVERY_MODE == "queue":
+            result = enqueue(
+                (
+                    recipient.telegram_id,
+                    partial(
+                        send_platform_notification,
+                        bot, recipient.telegram_id, event, recipient, rendered,
+                    ),
+                )
+                for recipient in pending
+            )
+            accepted = pending[:result["queued"]]
+        else:
+            accepted, send_error = await fan_out(event, pending, rendered, coalesce)
+            if accepted:
+                result = {"status": "sent"}
+            elif send_error is not None:
+                result = {"status": "error", "detail": send_error}
+            else:
+                result = {"status": "notifications_off"}
+    except BaseException:
+        dedup_cache.release(reserved)
+        raise
+
+    keys = [recipient_key(event, recipient.telegram_id) for recipient in accepted]
+    dedup_cache.release([key for key in reserved if key not in keys])
+    if len(accepted) == len(pending):
+        keys.append(event_key(event))
+    await dedup_cache.add(keys)
+    return result
+
+
+@app.post("/new_order")
+async def new_order(request: Request):
+    body = await request.body()
+    capture.record("/new_order", body)
+    try:
+        event = AlertEvent.from_dict(decode(body))
+    except PayloadError as e:
+        ALERT_EVENTS.inc("invalid_payload")
+        return invalid_payload(e)
+
+    if dedup_cache.seen(event_key(event)):
+        return counted({"status": "duplicate"})
+
+    recipients = await get_notification_recipients(event.username)
+    return to_response(counted(await process_order_event(event, recipients)))
+
+
+@app.post("/new_orders")
+async def new_orders(request: Request):
+    """Batch variant of /new_order: accepts a JSON array of the same payloads.
+
+    Recipients for all usernames in the batch are resolved in one database
+    pass. Events of one platform username are processed in order, so its
+    chats get them in order, while different usernames are processed
+    concurrently; a status is returned for each event in request order.
+    """
+    body = await request.body()
+    capture.record("/new_orders", body)
+    try:
+        items = decode(body)
+    except PayloadError as e:
+        return invalid_payload(e)
+    if not isinstance(items, list):
+        return invalid_payload(PayloadError("payload must be a JSON array"))
 
+    events = []
+    for item in items:
         try:
-            await send_platform_notification(bot, user_id, data)
-            sent_any = True
-        except Exception as e:
-            logger.error(f"Failed to send notification to {user_id}: {e}")
-            send_error = str(e)
+            events.append(AlertEvent.from_dict(item))
+        except PayloadError as e:
+            events.append(e)
+
+    fresh = [
+        event for event in events
+        if isinstance(event, AlertEvent) and not dedup_cache.seen(event_key(event))
+    ]
+    recipients_by_username = await get_notification_recipients_bulk(
+        [event.username for event in fresh]
+    )
+
+    results = [None] * len(events)
+    by_username = {}
+    for index, event in enumerate(events):
+        if isinstance(event, PayloadError):
+            results[index] = counted({"status": "invalid_payload", "detail": str(event)})
+        else:
+            by_username.setdefault(username_key(event.username), []).append(index)
 
-    if sent_any:
-        return {"status": "sent"}
-    if send_error is not None:
-        return {"status": "error", "detail": send_error}
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
 
-    return {"status": "notifications_off"}
+    async def process_username(indices):
+        async with semaphore:
+            for index in indices:
+                event = events[index]
+                if (
+                    event.username not in recipients_by_username
+                    or dedup_cache.seen(event_key(event))
+                ):
+                    results[index] = counted({"status": "duplicate"})
+                    continue
+                # Not coalesced: the events of a username are awaited one by
+                # one, so each held alert would cost a whole window
+                try:
+                    result = await process_order_event(
+                        event, recipients_by_username[event.username], coalesce=False
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to process batched event {event.order_id}: {e}")
+                    result = {"status": "error", "detail": str(e)}
+                results[index] = counted(result)
+
+    await asyncio.gather(*(process_username(indices) for indices in by_username.values()))
+    return {"status": "processed", "results": results}
 
 
 @app.post("/auth_status")
 async def auth_status(request: Request):
     """Endpoint to handle account authentication freeze updates."""
-    data = await request.json()
-    username = data.get("username")
-    freeze = str(data.get("authentication_freeze")).lower()
-    if username is None:
-        return {"status": "no_username"}
-
-    if freeze == "false":
-        users = get_user_ids_by_platform_username(username)
+    body = await request.body()
+    capture.record("/auth_status", body)
+    try:
+        event = AuthStatusEvent.from_dict(decode(body))
+    except PayloadError as e:
+        return invalid_payload(e)
+    username = event.username
+
+    if event.authentication_freeze == "false":
+        users = await get_user_ids_by_platform_username(username)
         if not users:
             logger.warning(f"No user found for platform_username={username}")
             return {"status": "no_user"}
 
+        if WEBHOOK_DELIVERY_MODE == "outbox":
+            return to_response(await store_in_outbox(users, UNFROZEN))
+
+        if WEBHOOK_DELIVERY_MODE == "queue":
+            return to_response(enqueue(
+                (user_id, partial(notify_account_unfrozen, bot, user_id))
+                for user_id in users
+            ))
+
         for user_id in users:
             await notify_account_unfrozen(bot, user_id)
 
         return {"status": "unfrozen_notified"}
 
     return {"status": "ignored"}
+
+
+@app.post("/order_update")
+async def order_update(request: Request):
+    """Edit the alerts already sent for an order instead of sending new ones."""
+    body = await request.body()
+    capture.record("/order_update", body)
+    try:
+        event = OrderUpdateEvent.from_dict(decode(body))
+    except PayloadError as e:
+        return invalid_payload(e)
+
+    await order_cache.set_status(event.order_id, event.status)
+    alerts = [alert for alert in await get_sent_alerts(event.order_id) if alert.status != event.status]
+    if not alerts:
+        return {"status": "no_alert"}
+
+    if WEBHOOK_DELIVERY_MODE == "outbox":
+        return to_response(await store_in_outbox([alert.chat_id for alert in alerts], UPDATE, event.payload))
+
+    if WEBHOOK_DELIVERY_MODE == "queue":
+        return to_response(enqueue(
+            (alert.chat_id, partial(update_order_alert, bot, alert.chat_id, event, alert))
+            for alert in alerts
+        ))
+
+    results = await asyncio.gather(
+        *(update_order_alert(bot, alert.chat_id, event, alert) for alert in alerts),
+        return_exceptions=True,
+    )
+    updated = 0
+    for alert, result in zip(alerts, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to update alert {event.order_id} in chat {alert.chat_id}: {result}")
+        else:
+            updated += 1
+    return {"status": "updated", "updated": updated}
+
+
+@app.post("/telegram/{secret}")
+async def telegram_update(secret: str, request: Request):
+    """Feed Telegram updates (webhook mode) into the PTB application."""
+    application = app.state.telegram_application
+    if application is None or not TELEGRAM_WEBHOOK_SECRET:
+        return JSONResponse(status_code=404, content={"status": "not_found"})
+
+    # compare_digest only takes ASCII str, a non-ASCII path would raise
+    expected = TELEGRAM_WEBHOOK_SECRET.encode()
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not (
+        hmac.compare_digest(secret.encode(), expected)
+        and hmac.compare_digest(header.encode(), expected)
+    ):
+        logger.warning("Rejected Telegram update with a wrong secret")
+        return JSONResponse(status_code=403, content={"status": "forbidden"})
+
+    try:
+        data = decode(await request.body())
+    except PayloadError as e:
+        return invalid_payload(e)
+    if not isinstance(data, dict):
+        return invalid_payload(PayloadError("payload must be a JSON object"))
+    update = Update.de_json(data, application.bot)
+    await application.update_queue.put(update)
+    return {"status": "ok"}